@@ -0,0 +1,80 @@
+"""
+Бенчмарк БД: задержка поиска во время пакетной записи.
+Сравнивает одно соединение без PRAGMA (журнал отката) и WAL с отдельным
+пулом соединений чтения.
+Запуск: python -m bench.bench_db [число записываемых доменов]
+"""
+import asyncio
+import logging
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from data.database_manager import IPDomainDatabaseAsync
+from data.resolutions import Resolutions
+from messages import logger
+
+IP_ADDRESSES = [f'10.0.{i >> 8}.{i & 255}' for i in range(200)]
+BATCH = 20_000
+
+
+def make_batch(start, count, rng):
+    ip_address = rng.choice(IP_ADDRESSES)
+    return {ip_address: Resolutions((f'sub{start + i}.example-{i % 97}.com' for i in range(count)),
+                                    (1722056400 + i for i in range(count)))}
+
+
+async def lookups(db, stop, rng):
+    latencies = []
+    errors = 0
+    while not stop.is_set():
+        ip_address = rng.choice(IP_ADDRESSES)
+        hosts = Resolutions((f'sub{rng.randrange(10 ** 6)}.example-1.com' for _ in range(40)), range(40))
+        started = time.perf_counter()
+        try:
+            await db.get_latest_dates(rng.sample(IP_ADDRESSES, 50))
+            await db.filter_new_domains({ip_address: hosts})
+        except Exception:
+            errors += 1
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+    return latencies, errors
+
+
+async def scenario(name, total, **options):
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        db = IPDomainDatabaseAsync(f'sqlite+aiosqlite:///{Path(workdir) / "bench.db"}', **options)
+        await db.init()
+        # Начальные данные, чтобы поиск шел по непустым таблицам
+        for start in range(0, 50_000, BATCH):
+            await db.save_data(make_batch(start, BATCH, rng))
+
+        stop = asyncio.Event()
+        reader = asyncio.create_task(lookups(db, stop, random.Random(1)))
+        started = time.perf_counter()
+        for start in range(10 ** 6, 10 ** 6 + total, BATCH):
+            await db.save_data(make_batch(start, BATCH, rng))
+        ingest_time = time.perf_counter() - started
+        stop.set()
+        latencies, errors = await reader
+        await db.close()
+
+    latencies.sort()
+    percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+    print(f"{name:<28} запись {total / ingest_time:9.0f} строк/с, поиск: {len(latencies):4} запросов, "
+          f"p50 {percentile(0.5):7.1f} мс, p95 {percentile(0.95):7.1f} мс, "
+          f"макс {latencies[-1] * 1000:7.1f} мс, ошибок {errors}")
+
+
+async def main(total):
+    await scenario('одно соединение, rollback', total, pragmas={}, read_pool_size=0)
+    await scenario('WAL + пул чтения', total)
+
+
+if __name__ == '__main__':
+    # Сообщения о каждой записи искажают замер
+    logger.setLevel(logging.WARNING)
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 200_000))
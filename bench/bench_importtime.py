@@ -0,0 +1,72 @@
+"""
+Время импорта короткой команды: `python -X importtime main.py status` во временной
+директории с пустой БД. Считается сумма времени модулей верхнего уровня, включая
+импортированные внутри команды, — то, что команда тратит на импорты при холодном старте.
+
+Запуск: python -m bench.bench_importtime [--budget 1000] [--command status] [--top 10]
+Код возврата 1, если время больше бюджета или загружен запрещенный модуль
+(клиенты VirusTotal и Telegram не нужны командам, которые не обращаются к API).
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# Бюджет импорта команды status по умолчанию, мс
+DEFAULT_BUDGET_MS = float(os.getenv('IMPORTTIME_BUDGET_MS', 1000))
+FORBIDDEN = ('vt', 'aiogram', 'aiohttp', 'pyarrow')
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+
+def measure(command):
+    """
+    Запускает main.py с -X importtime.
+    :return: Список пар (модуль верхнего уровня, суммарное время, мкс) и множество всех модулей
+    """
+    with tempfile.TemporaryDirectory() as workdir:
+        (Path(workdir) / 'data').mkdir()
+        (Path(workdir) / 'data' / 'ip_addresses.json').write_text('10.0.0.1\n')
+        env = {**os.environ, 'PYTHONPATH': str(ROOT), 'PYTHONDONTWRITEBYTECODE': '1'}
+        result = subprocess.run([sys.executable, '-X', 'importtime', str(ROOT / 'main.py'), *command],
+                                cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(f"main.py {' '.join(command)} завершился с кодом {result.returncode}:\n{result.stderr[-2000:]}")
+    top_level, modules = [], set()
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, name = match.groups()
+        modules.add(name)
+        if not indent:
+            top_level.append((name, int(cumulative)))
+    return top_level, modules
+
+
+def run(args):
+    # Первый запуск компилирует и кэширует байт-код, в зачет идет лучший из повторов
+    runs = [measure(args.command) for _ in range(args.repeat + 1)][1:]
+    top_level, modules = min(runs, key=lambda run: sum(cumulative for _, cumulative in run[0]))
+    total_ms = sum(cumulative for _, cumulative in top_level) / 1000
+    print(f"main.py {' '.join(args.command)}: импорты {total_ms:.0f} мс (бюджет {args.budget:.0f} мс), "
+          f"модулей {len(modules)}")
+    for name, cumulative in sorted(top_level, key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative / 1000:8.1f} мс  {name}")
+    forbidden = sorted({name.split('.')[0] for name in modules} & set(FORBIDDEN))
+    if forbidden:
+        print(f"загружены запрещенные модули: {', '.join(forbidden)}")
+    return total_ms <= args.budget and not forbidden
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Проверка времени импорта короткой команды main.py')
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_MS, help='бюджет, мс')
+    parser.add_argument('--command', nargs='+', default=['status'], help='команда main.py с аргументами')
+    parser.add_argument('--repeat', type=int, default=3, help='число замеров')
+    parser.add_argument('--top', type=int, default=10, help='показать самые долгие импорты')
+    args = parser.parse_args()
+    sys.exit(0 if run(args) else 1)
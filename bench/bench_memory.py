@@ -0,0 +1,93 @@
+"""
+Бенчмарк памяти на одно разрешение IP-адреса в разных представлениях.
+Страницы приходят как JSON ответа VirusTotal, каждая разбирается json.loads,
+поэтому одинаковые имена хостов — разные строки, как при реальном обходе.
+Запуск: python -m bench.bench_memory [количество разрешений]
+"""
+import gc
+import json
+import sys
+import tracemalloc
+
+from data.resolutions import Resolutions
+
+IP_ADDRESS = '203.0.113.42'
+PAGE_SIZE = 40
+
+
+def iter_pages(count, repeat=3):
+    """
+    Страницы ответа /resolutions. Каждое имя хоста встречается repeat раз
+    с разными датами.
+    """
+    for start in range(0, count, PAGE_SIZE):
+        data = [
+            {
+                'id': f'{IP_ADDRESS}sub{i // repeat}.example-{i % 97}.com',
+                'type': 'resolution',
+                'links': {'self': f'https://www.virustotal.com/api/v3/resolutions/{IP_ADDRESS}sub{i}'},
+                'attributes': {
+                    'host_name': f'sub{i // repeat}.example-{i // repeat % 97}.com',
+                    'ip_address': IP_ADDRESS,
+                    'date': 1722056400 - i * 3600,
+                    'resolver': 'VirusTotal',
+                    'host_name_last_analysis_stats': {'harmless': 60, 'malicious': 0, 'suspicious': 0},
+                    'ip_address_last_analysis_stats': {'harmless': 60, 'malicious': 0, 'suspicious': 0},
+                },
+            }
+            for i in range(start, min(start + PAGE_SIZE, count))
+        ]
+        yield json.dumps({'data': data})
+
+
+def raw_json(pages):
+    # Полные объекты ответа, как хранились до проекции
+    result = []
+    for page in pages:
+        result.extend(json.loads(page)['data'])
+    return result
+
+
+def dicts(pages):
+    # Словарь на запись с повтором IP-адреса (прежний transform_ip_resolutions)
+    result = []
+    for page in pages:
+        for item in json.loads(page)['data']:
+            attributes = item['attributes']
+            result.append({'ip_address': IP_ADDRESS, 'host_name': attributes['host_name'],
+                           'date': attributes['date']})
+    return result
+
+
+def columnar(pages):
+    result = Resolutions()
+    for page in pages:
+        for item in json.loads(page)['data']:
+            attributes = item['attributes']
+            result.append(attributes['host_name'], attributes['date'])
+    return result
+
+
+def measure(build, pages):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = build(pages)
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def main(sizes):
+    for count in sizes:
+        pages = list(iter_pages(count))
+        print(f"{count:>8} разрешений:")
+        for name, build in (('raw json', raw_json), ('dicts', dicts), ('Resolutions', columnar)):
+            size = measure(build, pages)
+            print(f"    {name:<12} {size / 2 ** 20:8.1f} МБ, {size / count:7.1f} байт на запись")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10_000, 100_000])
@@ -0,0 +1,38 @@
+"""
+Бенчмарк формирования сообщений Telegram.
+Запуск: python -m bench.bench_messages [количество доменов]
+"""
+import sys
+import time
+
+from data.resolutions import Resolutions
+from messages.message import iter_telegram_messages, telegram_length, MESSAGE_LIMIT
+
+
+def make_new_domains(count, ip_address='203.0.113.42'):
+    return {
+        ip_address: Resolutions((f'sub{i}.example-{i % 97}.com' for i in range(count)),
+                                (1722056400 + i for i in range(count)))
+    }
+
+
+def main(sizes):
+    for count in sizes:
+        new_domains = make_new_domains(count)
+        started = time.perf_counter()
+        first = None
+        parts = 0
+        longest = 0
+        for message in iter_telegram_messages(new_domains):
+            if first is None:
+                first = time.perf_counter() - started
+            parts += 1
+            longest = max(longest, telegram_length(message))
+        elapsed = time.perf_counter() - started
+        assert longest <= MESSAGE_LIMIT, f"часть длиной {longest} превышает лимит"
+        print(f"{count:>8} доменов: {elapsed * 1000:8.1f} мс, первое сообщение через "
+              f"{first * 1000:.2f} мс, частей {parts}, макс. длина {longest}")
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1_000, 10_000, 100_000])
@@ -0,0 +1,117 @@
+"""
+Проверка режима worker: N процессов `main.py worker --once` с одной базой SQLite
+и локальными заменами VirusTotal и Telegram. Каждый IP-адрес должен быть обойден
+ровно один раз, в том числе когда один процесс аварийно завершается посреди пакета,
+а каждое сообщение telegram_outbox — отправлено одним процессом.
+
+Запуск: python -m bench.bench_workers [--workers 4] [--size 200] [--kill-after 1.0]
+Код возврата 1, если какой-то IP-адрес обойден не один раз или пропущен
+либо число отправленных сообщений не совпадает с числом строк telegram_outbox.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench.fake_telegram import FakeTelegram
+from bench.fake_vt import FakeVirusTotal
+from bench.run_bench import ROOT, start_server, synthetic_watchlist
+
+
+async def init_db(workdir):
+    # Схема создается заранее, чтобы процессы не выполняли миграции одновременно
+    from data.database_manager import IPDomainDatabaseAsync
+    db = IPDomainDatabaseAsync(f'sqlite+aiosqlite:///{workdir / "data" / "ip_domains.db"}')
+    await db.init()
+    await db.close()
+
+
+def count_outbox(db_path):
+    """
+    :return: Количество строк telegram_outbox и количество доставленных
+    """
+    with sqlite3.connect(db_path) as conn:
+        return conn.execute("SELECT COUNT(*), COUNT(delivered_at) FROM telegram_outbox").fetchone()
+
+
+async def run(args):
+    fake_vt = FakeVirusTotal(resolutions_per_ip=args.resolutions, latency=args.latency)
+    fake_tg = FakeTelegram()
+    vt_runner, vt_url = await start_server(fake_vt.app())
+    tg_runner, tg_url = await start_server(fake_tg.app())
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            workdir = Path(workdir)
+            (workdir / 'data').mkdir()
+            (workdir / 'data' / 'ip_addresses.json').write_text(json.dumps(synthetic_watchlist(args.size)))
+            await init_db(workdir)
+            env = {
+                **os.environ,
+                'PYTHONPATH': str(ROOT),
+                'VT_API_HOST': vt_url,
+                'VT_REQUESTS_PER_MINUTE': '600',
+                'VT_REQUESTS_PER_DAY': '10000000',
+                'TELEGRAM_BOT_API_TOKEN': '123456:bench',
+                'TELEGRAM_CHANNEL_INFO': '-100',
+                'TELEGRAM_API_URL': tg_url,
+                'TELEGRAM_CHAT_PER_MINUTE': '60000',
+                'WORKER_BATCH_SIZE': str(args.batch_size),
+                'WORKER_LEASE_SECONDS': str(args.lease_seconds),
+            }
+            started = time.time()
+            processes = [
+                subprocess.Popen([sys.executable, str(ROOT / 'main.py'), 'worker', '--once'], cwd=workdir,
+                                 env={**env, 'VT_API_KEYS': f'worker-key-{i}'},
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                for i in range(args.workers)
+            ]
+            if args.kill_after:
+                # Аварийное завершение: аренда процесса должна перейти к остальным
+                await asyncio.sleep(args.kill_after)
+                processes[0].send_signal(signal.SIGKILL)
+            returncodes = [await asyncio.to_thread(process.wait) for process in processes]
+            wall_time = time.time() - started
+            outbox_rows, delivered = count_outbox(workdir / 'data' / 'ip_domains.db')
+    finally:
+        await vt_runner.cleanup()
+        await tg_runner.cleanup()
+
+    watchlist = synthetic_watchlist(args.size)
+    # Убитый процесс мог получить страницы, но не успеть их сохранить: такие IP-адреса
+    # обходятся повторно, их число не больше размера пакета
+    repeated = {ip_address: count for ip_address, count in fake_vt.crawls.items() if count > 1}
+    missing = [ip_address for ip_address in watchlist if not fake_vt.crawls[ip_address]]
+    allowed = args.batch_size if args.kill_after else 0
+    print(f"процессов {args.workers}, IP {args.size}, {wall_time:.1f} с, коды завершения {returncodes}")
+    print(f"запросов к VT по ключам: {dict(fake_vt.calls)}")
+    print(f"пропущено IP: {len(missing)}, обойдено повторно: {len(repeated)} (допустимо {allowed})")
+    print(f"сообщений в telegram_outbox: {outbox_rows}, доставлено: {delivered}, "
+          f"отправлено в Telegram: {fake_tg.sent}")
+    if args.kill_after:
+        # Убитый процесс мог отправить сообщения, не успев записать отметки о доставке,
+        # а захваченные им и не отправленные сообщения ждут истечения захвата
+        sent_ok = delivered <= fake_tg.sent
+    else:
+        sent_ok = fake_tg.sent == outbox_rows == delivered
+    return not missing and len(repeated) <= allowed and sent_ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Проверка распределения IP-адресов между процессами')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--size', type=int, default=200, help='число IP-адресов')
+    parser.add_argument('--resolutions', type=int, default=100, help='максимум разрешений на IP')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа VT, с')
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--lease-seconds', type=int, default=10)
+    parser.add_argument('--kill-after', type=float, default=0.0,
+                        help='убить первый процесс через столько секунд (0 — не убивать)')
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(run(args)) else 1)
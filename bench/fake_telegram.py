@@ -0,0 +1,47 @@
+"""
+Локальная замена Telegram Bot API для бенчмарков: POST /bot{token}/sendMessage
+с ответами retry_after для части запросов.
+"""
+import time
+
+from aiohttp import web
+
+
+class FakeTelegram:
+    def __init__(self, retry_every=0, retry_after=1):
+        """
+        :param retry_every: Каждый N-й запрос получает 429 с retry_after (0 — никогда)
+        :param retry_after: Значение retry_after, секунды
+        """
+        self.retry_every = retry_every
+        self.retry_after = retry_after
+        self.calls = 0
+        self.sent = 0
+        self.first_message_at = None
+
+    async def send_message(self, request):
+        self.calls += 1
+        data = await request.post() if request.content_type != 'application/json' else await request.json()
+        if self.retry_every and self.calls % self.retry_every == 0:
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        self.sent += 1
+        if self.first_message_at is None:
+            self.first_message_at = time.time()
+        return web.json_response({
+            'ok': True,
+            'result': {
+                'message_id': self.sent,
+                'date': int(time.time()),
+                'chat': {'id': -100, 'type': 'channel', 'title': 'bench'},
+                'text': data.get('text', ''),
+            },
+        })
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bot{token}/sendMessage', self.send_message)
+        return app
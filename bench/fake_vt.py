@@ -0,0 +1,84 @@
+"""
+Локальная замена API VirusTotal для бенчмарков:
+GET /api/v3/ip_addresses/{ip}/resolutions с курсорами, задержкой, 429 и квотой.
+"""
+import asyncio
+import random
+import time
+import zlib
+from collections import Counter
+
+from aiohttp import web
+
+
+class FakeVirusTotal:
+    def __init__(self, resolutions_per_ip=100, latency=0.0, error_rate=0.0,
+                 quota_per_key=None, seed=0):
+        """
+        :param resolutions_per_ip: Максимальное число разрешений у одного IP
+        :param latency: Задержка ответа, секунды
+        :param error_rate: Доля ответов 429 TooManyRequestsError
+        :param quota_per_key: Дневная квота на ключ (None — без ограничения)
+        """
+        self.resolutions_per_ip = resolutions_per_ip
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota_per_key = quota_per_key
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        # Запросы первой страницы по IP-адресам: сколько раз начинался обход
+        self.crawls = Counter()
+        self.now = int(time.time())
+
+    def _resolutions_count(self, ip_address):
+        # Детерминированное число разрешений для IP: от 1 до resolutions_per_ip
+        return zlib.crc32(ip_address.encode()) % self.resolutions_per_ip + 1
+
+    @staticmethod
+    def _error(status, code, message):
+        return web.json_response({'error': {'code': code, 'message': message}}, status=status)
+
+    async def resolutions(self, request):
+        api_key = request.headers.get('X-Apikey', '')
+        self.calls[api_key] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.quota_per_key is not None and self.calls[api_key] > self.quota_per_key:
+            return self._error(429, 'QuotaExceededError', 'Quota exceeded')
+        if self.error_rate and self.random.random() < self.error_rate:
+            return self._error(429, 'TooManyRequestsError', 'Too many requests')
+
+        ip_address = request.match_info['ip']
+        limit = int(request.query.get('limit', 40))
+        offset = int(request.query.get('cursor', 0))
+        if not offset:
+            self.crawls[ip_address] += 1
+        total = self._resolutions_count(ip_address)
+        end = min(offset + limit, total)
+        data = [
+            {
+                'id': f'{ip_address}sub{i}.example.com',
+                'type': 'resolution',
+                'attributes': {
+                    'host_name': f'sub{i}.{ip_address.replace(".", "-")}.example.com',
+                    'ip_address': ip_address,
+                    # Разрешения отдаются от новых к старым, как в VirusTotal
+                    'date': self.now - i * 3600,
+                },
+            }
+            for i in range(offset, end)
+        ]
+        response = {'data': data, 'links': {'self': str(request.url)}, 'meta': {}}
+        if end < total:
+            response['links']['next'] = f'{request.url}&cursor={end}'
+            response['meta']['cursor'] = str(end)
+        return web.json_response(response)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get('/api/v3/ip_addresses/{ip}/resolutions', self.resolutions)
+        return app
+
+    @property
+    def total_calls(self):
+        return sum(self.calls.values())
@@ -0,0 +1,146 @@
+"""
+Сквозной бенчмарк: main.main на синтетическом списке IP-адресов
+с локальными заменами VirusTotal и Telegram.
+
+Запуск:  python -m bench.run_bench [--sizes 10 1000 100000] [--latency 0.05] ...
+Отчет:   python -m bench.run_bench --report
+Результаты дописываются в bench/results.jsonl вместе с хешем коммита.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiohttp import web
+
+from bench.fake_telegram import FakeTelegram
+from bench.fake_vt import FakeVirusTotal
+
+ROOT = Path(__file__).resolve().parent.parent
+RESULTS_FILE = ROOT / 'bench' / 'results.jsonl'
+
+
+def git_commit():
+    result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                            capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+
+def synthetic_watchlist(size):
+    # Адреса из 10.0.0.0/8, по одному на каждый номер
+    return [f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}' for i in range(1, size + 1)]
+
+
+async def start_server(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}'
+
+
+def run_main(workdir, env):
+    """
+    Запускает main.py в отдельном процессе и возвращает его rusage.
+    """
+    process = subprocess.Popen([sys.executable, str(ROOT / 'main.py'), 'run'], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage
+
+
+async def run_scenario(size, args):
+    fake_vt = FakeVirusTotal(resolutions_per_ip=args.resolutions, latency=args.latency,
+                             error_rate=args.error_rate, quota_per_key=args.quota)
+    fake_tg = FakeTelegram(retry_every=args.retry_every)
+    vt_runner, vt_url = await start_server(fake_vt.app())
+    tg_runner, tg_url = await start_server(fake_tg.app())
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            data_dir = Path(workdir) / 'data'
+            data_dir.mkdir()
+            (data_dir / 'ip_addresses.json').write_text(json.dumps(synthetic_watchlist(size)))
+            env = {
+                **os.environ,
+                'PYTHONPATH': str(ROOT),
+                'VT_API_KEYS': ','.join(f'bench-key-{i}' for i in range(args.keys)),
+                'VT_API_HOST': vt_url,
+                'VT_REQUESTS_PER_MINUTE': str(args.per_minute),
+                'VT_REQUESTS_PER_DAY': str(args.per_day),
+                'TELEGRAM_BOT_API_TOKEN': '123456:bench',
+                'TELEGRAM_CHANNEL_INFO': '-100',
+                'TELEGRAM_API_URL': tg_url,
+                'TELEGRAM_CHAT_PER_MINUTE': str(args.chat_per_minute),
+            }
+            started = time.time()
+            returncode, rusage = await asyncio.to_thread(run_main, workdir, env)
+            wall_time = time.time() - started
+    finally:
+        await vt_runner.cleanup()
+        await tg_runner.cleanup()
+
+    return {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'ip_addresses': size,
+        'params': {key: value for key, value in vars(args).items() if key not in ('sizes', 'report')},
+        'returncode': returncode,
+        'wall_time': round(wall_time, 3),
+        'vt_calls': fake_vt.total_calls,
+        'telegram_calls': fake_tg.calls,
+        'messages_sent': fake_tg.sent,
+        # ru_maxrss в Linux — килобайты
+        'peak_rss_mb': round(rusage.ru_maxrss / 1024, 1),
+        'time_to_first_alert': (round(fake_tg.first_message_at - started, 3)
+                                if fake_tg.first_message_at else None),
+    }
+
+
+def print_report(limit=20):
+    if not RESULTS_FILE.exists():
+        print("Результатов пока нет")
+        return
+    rows = [json.loads(line) for line in RESULTS_FILE.read_text().splitlines() if line.strip()]
+    print(f"{'commit':<10}{'IP':>8}{'wall, s':>10}{'VT calls':>10}{'TG calls':>10}"
+          f"{'RSS, MB':>10}{'1st alert, s':>14}")
+    for row in rows[-limit:]:
+        first = row['time_to_first_alert']
+        print(f"{row['commit']:<10}{row['ip_addresses']:>8}{row['wall_time']:>10.2f}"
+              f"{row['vt_calls']:>10}{row['telegram_calls']:>10}{row['peak_rss_mb']:>10.1f}"
+              f"{first if first is not None else '-':>14}")
+
+
+async def main(args):
+    for size in args.sizes:
+        result = await run_scenario(size, args)
+        with RESULTS_FILE.open('a', encoding='utf-8') as file:
+            file.write(json.dumps(result, ensure_ascii=False) + '\n')
+        print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сквозной бенчмарк MonitorWeb')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--resolutions', type=int, default=100, help='максимум разрешений на IP')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа VT, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 429 от VT')
+    parser.add_argument('--quota', type=int, default=None, help='квота fake VT на ключ')
+    parser.add_argument('--keys', type=int, default=1)
+    parser.add_argument('--per-minute', type=int, default=60000, help='лимит ключа в минуту')
+    parser.add_argument('--per-day', type=int, default=10_000_000, help='лимит ключа в сутки')
+    parser.add_argument('--retry-every', type=int, default=0, help='каждый N-й sendMessage получает 429')
+    parser.add_argument('--chat-per-minute', type=int, default=60000)
+    parser.add_argument('--report', action='store_true', help='показать сохраненные результаты')
+    args = parser.parse_args()
+    if args.report:
+        print_report()
+    else:
+        asyncio.run(main(args))
@@ -0,0 +1,74 @@
+import asyncio
+import math
+import signal
+from datetime import datetime, timedelta, timezone
+
+from messages import logger
+
+
+def seconds_until_quota_reset():
+    """
+    Секунды до сброса дневной квоты VirusTotal (00:00 UTC).
+    """
+    now = datetime.now(timezone.utc)
+    reset = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return (reset - now).total_seconds()
+
+
+class Daemon:
+    """
+    Долгоживущий режим вместо cron: запускает цикл обработки каждые interval
+    секунд и делит остаток дневной квоты поровну между оставшимися за сутки циклами.
+    """
+    def __init__(self, request, cycle, interval=1800):
+        """
+        :param request: Request, пул ключей которого открыт на время работы демона
+        :param cycle: Корутинная функция цикла, принимает бюджет запросов
+        :param interval: Интервал между запусками цикла в секундах
+        """
+        self.request = request
+        self.cycle = cycle
+        self.interval = interval
+        self.stop_event = asyncio.Event()
+
+    def stop(self):
+        """
+        Обработчик SIGTERM/SIGINT: новые запросы к API прекращаются,
+        уже полученные данные сохраняются и отправляются.
+        """
+        if not self.stop_event.is_set():
+            logger.info("Получен сигнал остановки, завершаем текущий цикл")
+            self.stop_event.set()
+            self.request.pool.stop()
+
+    async def cycle_budget(self):
+        """
+        Бюджет запросов на цикл: остаток квоты на число оставшихся за сутки циклов.
+        """
+        remaining = await self.request.pool.remaining()
+        cycles_left = max(math.ceil(seconds_until_quota_reset() / self.interval), 1)
+        return math.ceil(remaining / cycles_left)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        while not self.stop_event.is_set():
+            started = loop.time()
+            budget = await self.cycle_budget()
+            if budget:
+                logger.info(f"Запуск цикла, бюджет запросов: {budget}")
+                try:
+                    await self.cycle(budget)
+                except Exception as e:
+                    logger.error(f"Ошибка в цикле обработки: {e}")
+            else:
+                logger.info("Дневная квота исчерпана, ожидаем следующий цикл")
+
+            delay = max(self.interval - (loop.time() - started), 0)
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+        logger.info("Демон остановлен")
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import signal
+import socket
+import time
+from datetime import datetime, timedelta
+
+from messages import logger
+from .daemon import seconds_until_quota_reset
+
+
+class Worker:
+    """
+    Один из нескольких процессов, обрабатывающих общий список наблюдения.
+    IP-адреса берутся из таблицы ip_leases в аренду пакетами; пока пакет
+    обрабатывается, аренда продлевается, а каждый сохраненный IP-адрес
+    сразу освобождается. Аренду аварийно завершившегося процесса после
+    истечения срока забирает другой процесс. Таблица аренды периодически
+    сверяется со списком наблюдения.
+    """
+    def __init__(self, request, db, process, worker_id=None, batch_size=20, lease_seconds=300,
+                 recrawl_seconds=1800, idle_seconds=60, sync_seconds=300):
+        """
+        :param request: Request, пул ключей которого открыт на время работы
+        :param db: IPDomainDatabaseAsync
+        :param process: Корутинная функция обработки пакета, принимает список
+                        IP-адресов и функцию complete
+        :param worker_id: Идентификатор процесса, по умолчанию хост:pid
+        :param batch_size: Количество IP-адресов в одной аренде
+        :param lease_seconds: Срок аренды; продлевается каждую треть срока
+        :param recrawl_seconds: Интервал между обходами одного IP-адреса
+        :param idle_seconds: Пауза, когда свободных IP-адресов нет
+        :param sync_seconds: Интервал сверки таблицы аренды со списком наблюдения
+        """
+        self.request = request
+        self.db = db
+        self.process = process
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.recrawl_seconds = recrawl_seconds
+        self.idle_seconds = idle_seconds
+        self.sync_seconds = sync_seconds
+        self.synced_at = None
+        self.stop_event = asyncio.Event()
+        self.completed = 0
+
+    def stop(self):
+        """
+        Обработчик SIGTERM/SIGINT: текущий пакет сохраняется, необработанные
+        IP-адреса возвращаются в общий список.
+        """
+        if not self.stop_event.is_set():
+            logger.info(f"Процесс {self.worker_id}: получен сигнал остановки")
+            self.stop_event.set()
+            self.request.pool.stop()
+
+    async def complete(self, ip_address):
+        """
+        Освобождает IP-адрес после записи результатов его обхода.
+        """
+        await self.db.release_leases(self.worker_id, [ip_address])
+        self.completed += 1
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            renewed = await self.db.renew_leases(self.worker_id, self.lease_seconds)
+            logger.debug(f"Процесс {self.worker_id}: продлена аренда {renewed} IP-адресов")
+
+    async def _wait(self, delay):
+        try:
+            await asyncio.wait_for(self.stop_event.wait(), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
+    async def sync(self, load_watchlist):
+        """
+        Добавляет в таблицу аренды новые IP-адреса списка наблюдения и удаляет
+        исключенные из него.
+        """
+        added, removed = await self.db.sync_leases(await load_watchlist())
+        self.synced_at = time.monotonic()
+        if added or removed:
+            logger.info(f"Процесс {self.worker_id}: в таблицу аренды добавлено {added} IP-адресов, "
+                        f"удалено {removed}")
+
+    async def claim(self, load_watchlist):
+        """
+        Берет в аренду следующий пакет. Перед этим, если с прошлой сверки прошло
+        sync_seconds, сверяет таблицу аренды со списком наблюдения.
+        """
+        if self.synced_at is None or time.monotonic() - self.synced_at >= self.sync_seconds:
+            await self.sync(load_watchlist)
+        done_before = datetime.utcnow() - timedelta(seconds=self.recrawl_seconds)
+        return await self.db.claim_leases(self.worker_id, self.batch_size, self.lease_seconds, done_before)
+
+    async def run(self, load_watchlist, once=False):
+        """
+        :param load_watchlist: Корутинная функция, возвращает итерируемое IP-адресов
+        :param once: Завершиться, когда все IP-адреса круга обработаны: свободных нет
+                     и другие процессы ничего не арендуют
+        """
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.stop)
+
+        logger.info(f"Процесс {self.worker_id} запущен")
+        attempted = set()
+        while not self.stop_event.is_set():
+            if not await self.request.pool.remaining():
+                if once:
+                    logger.info("Дневная квота исчерпана")
+                    break
+                logger.info("Дневная квота исчерпана, ожидаем ее сброса")
+                await self._wait(seconds_until_quota_reset())
+                continue
+
+            batch = await self.claim(load_watchlist)
+            if once and batch and attempted.issuperset(batch):
+                # Остались только IP-адреса, которые этот процесс уже не смог обработать
+                await self.db.release_leases(self.worker_id, batch, done=False)
+                break
+            if not batch:
+                if once and not await self.db.count_active_leases():
+                    break
+                # Аренда другого процесса может истечь, если он завершился аварийно
+                await self._wait(self.lease_seconds / 3 if once else self.idle_seconds)
+                continue
+            if once:
+                attempted.update(batch)
+
+            logger.info(f"Процесс {self.worker_id}: арендовано {len(batch)} IP-адресов")
+            heartbeat = asyncio.create_task(self._heartbeat())
+            try:
+                await self.process(batch, self.complete)
+            except Exception as e:
+                logger.error(f"Ошибка обработки пакета: {e}")
+            finally:
+                heartbeat.cancel()
+                await asyncio.gather(heartbeat, return_exceptions=True)
+                # Отложенные из-за квоты и необработанные IP-адреса достанутся другим процессам
+                await self.db.release_leases(self.worker_id, batch, done=False)
+        logger.info(f"Процесс {self.worker_id} остановлен, обработано IP-адресов: {self.completed}")
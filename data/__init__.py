@@ -1,2 +1,5 @@
+from .resolutions import *
+from .watchlist import *
 from .data_processor import *
-from .database_manager import *
\ No newline at end of file
+from .database_manager import *
+from .export import *
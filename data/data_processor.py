@@ -1,53 +1,46 @@
 import aiofiles
 import json
 
+from .resolutions import as_resolutions
+from .watchlist import load_watchlist
+
 def transform_ip_resolutions(ip_resolutions):
     """
     Преобразует данные о разрешениях IP в удобный формат.
-    :param ip_resolutions: Словарь, где ключ — IP-адрес, а значение — список данных о доменах
-    :return: Новый словарь с ключами IP-адресов и значениями списков словарей с 'date', 'host_name' и 'ip_address'
+    IP-адрес хранится только ключом словаря, записи не копируются.
+    :param ip_resolutions: Словарь, где ключ — IP-адрес, а значение — Resolutions
+                           или список словарей с 'host_name' и 'date'
+    :return: Новый словарь с ключами IP-адресов и значениями Resolutions
     """
-    transformed_data = {}
-    for ip_address, resolutions in ip_resolutions.items():
-        transformed_data[ip_address] = []
-        for resolution in resolutions:
-            # Извлекаем необходимые данные
-            attributes = resolution.get('attributes', {})
-            host_name = attributes.get('host_name')
-            date = attributes.get('date')
-
-            transformed_data[ip_address].append({
-                'ip_address': ip_address,
-                'host_name': host_name,
-                'date': date
-            })
-    return transformed_data
-
-
-async def read_ip_addresses(file_path='data/ip_addresses.json'):
+    return {ip_address: as_resolutions(resolutions)
+            for ip_address, resolutions in ip_resolutions.items()}
+
+
+async def read_ip_addresses(file_path='data/ip_addresses.json', denylist_path=None):
     """
-    Асинхронно читает IP-адреса из JSON-файла.
-    :param file_path: Путь к JSON-файлу
-    :return: Список IP-адресов
+    Асинхронно читает отслеживаемые IP-адреса: отдельные адреса, блоки CIDR
+    и диапазоны из JSON-списка или файла с записью в каждой строке.
+    :param file_path: Путь к файлу IP-адресов
+    :param denylist_path: Путь к файлу исключаемых адресов или None
+    :return: Watchlist — каждый обход разворачивает адреса генератором, без повторов
     """
-    async with aiofiles.open(file_path, mode='r', encoding='utf-8') as file:
-        contents = await file.read()
-        ip_addresses = json.loads(contents)
-    return ip_addresses
+    return await load_watchlist(file_path, denylist_path)
 
 async def main():
     file_path = 'ip_addresses.json'
     ip_addresses = await read_ip_addresses(file_path)
-    print(f"Извлеченные IP-адреса: {ip_addresses}")
+    print(f"Извлеченные IP-адреса: {list(ip_addresses)}")
 
 async def save_data_as_json(transform_ip_resolutions_, new_domains):
     # Сохранение transformdata
     async with aiofiles.open('data/example_data/transform_ip_resolutions_.json', 'w', encoding='utf-8') as outfile:
-        await outfile.write(json.dumps(transform_ip_resolutions_, indent=4))
+        await outfile.write(json.dumps({ip: as_resolutions(data).to_records()
+                                        for ip, data in transform_ip_resolutions_.items()}, indent=4))
 
     # Сохранение new_domains
     async with aiofiles.open('data/example_data/new_domains.json', 'w', encoding='utf-8') as outfile:
-        await outfile.write(json.dumps(new_domains, indent=4))
+        await outfile.write(json.dumps({ip: as_resolutions(data).to_records()
+                                        for ip, data in new_domains.items()}, indent=4))
 
 
 if __name__ == "__main__":
@@ -1,102 +1,980 @@
 import asyncio
+import heapq
+import ipaddress
+import json
+from itertools import islice
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, func, select
-from datetime import datetime
+from sqlalchemy import (Column, Integer, String, Text, DateTime, Boolean, LargeBinary, ForeignKey, Index,
+                        case, column, event, func, make_url, or_, select, delete, update, bindparam, text,
+                        values)
+from sqlalchemy.dialects.sqlite import insert
+from datetime import datetime, timedelta, timezone
 
 from messages import logger
+from metrics import DB_QUERY_SECONDS, DB_ROWS, timed
+from .migrations import migrate
+from .resolutions import Resolutions, as_resolutions
 
 Base = declarative_base()
 
-class IPDomainMapping(Base):
-    __tablename__ = 'ip_domain_mappings'
+# Настройки соединений SQLite. journal_mode=WAL сохраняется в файле БД и позволяет
+# читать параллельно с записью; synchronous=NORMAL в WAL не теряет целостность
+# при сбое процесса, но не ждет fsync на каждую транзакцию
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 256 * 2 ** 20,
+    # Отрицательное значение — размер в КиБ
+    'cache_size': -64 * 2 ** 10,
+    'busy_timeout': 30000,
+    'temp_store': 'MEMORY',
+}
+# Для соединений чтения журнал и синхронизация не задаются
+READER_PRAGMAS = ('mmap_size', 'cache_size', 'busy_timeout', 'temp_store')
+
+def chunks(iterable, size):
+    """
+    Разбивает итерируемый объект на списки длиной не больше size.
+    """
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+def pack_ip(ip_address):
+    """
+    :return: Упакованный адрес: 4 байта IPv4 или 16 байт IPv6
+    :raises ValueError: если строка не является IP-адресом
+    """
+    return ipaddress.ip_address(ip_address.strip()).packed
+
+def unpack_ip(packed):
+    return str(ipaddress.ip_address(packed))
+
+def normalize_host(host_name):
+    """
+    Имя хоста в нижнем регистре без завершающей точки.
+    """
+    return host_name.strip().rstrip('.').lower()
+
+def reverse_host(host_name):
+    """
+    Имя хоста с метками в обратном порядке и точкой в конце: sub.example.com → com.example.sub.
+    Все поддомены зоны имеют общий префикс, поэтому поиск по зоне — диапазон индекса.
+    """
+    return '.'.join(reversed(host_name.split('.'))) + '.'
+
+def zone_range(zone):
+    """
+    :return: Границы [от, до) reverse_host для зоны и всех ее поддоменов
+    """
+    prefix = reverse_host(normalize_host(zone))
+    # '/' — следующий после '.' символ
+    return prefix, prefix[:-1] + '/'
+
+def to_timestamp(value):
+    """
+    Переводит datetime в UNIX timestamp. Naive datetime считается UTC,
+    у aware учитывается смещение.
+    """
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.astimezone(timezone.utc).timestamp())
+
+class IP(Base):
+    __tablename__ = 'ips'
+
+    id = Column(Integer, primary_key=True)
+    address = Column(LargeBinary, nullable=False, unique=True)
+
+class Host(Base):
+    __tablename__ = 'hosts'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    # reverse_host(name) для поиска по зоне
+    reversed_name = Column(String, index=True)
+
+class IPHost(Base):
+    """
+    Разрешение IP-адреса в имя хоста. Даты — UNIX timestamp: дата разрешения
+    при первом сохранении пары и самая поздняя известная дата.
+    """
+    __tablename__ = 'ip_hosts'
+
+    ip_id = Column(Integer, ForeignKey('ips.id'), primary_key=True)
+    host_id = Column(Integer, ForeignKey('hosts.id'), primary_key=True)
+    first_seen = Column(Integer, nullable=False)
+    last_seen = Column(Integer, nullable=False)
+    # Время записи пары в БД (UNIX timestamp) для инкрементальной выгрузки;
+    # 0 — пара записана до появления столбца
+    added_at = Column(Integer, nullable=False, default=0, server_default='0')
+
+    __table_args__ = (
+        Index('ix_ip_hosts_ip_first_seen', 'ip_id', 'first_seen'),
+        Index('ix_ip_hosts_added_at', 'added_at'),
+        # Обратный поиск: IP-адреса по имени хоста
+        Index('ix_ip_hosts_host', 'host_id'),
+        # Строки хранятся прямо в B-дереве первичного ключа, без отдельного rowid
+        {'sqlite_with_rowid': False},
+    )
+
+class APIQuotaUsage(Base):
+    __tablename__ = 'api_quota_usage'
+
+    key_id = Column(String, primary_key=True)
+    day = Column(String, primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+
+class CrawlCheckpoint(Base):
+    __tablename__ = 'crawl_checkpoints'
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    ip_address = Column(String, nullable=False)
-    host_name = Column(String, nullable=False)
-    date = Column(DateTime, nullable=False)
+    ip_address = Column(String, nullable=False, index=True)
+    # Курсор следующей страницы; None — обход IP-адреса завершен
+    cursor = Column(String)
+    # JSON-список пар [host_name, date] полученной страницы
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class PendingIP(Base):
+    __tablename__ = 'pending_ips'
+
+    ip_address = Column(String, primary_key=True)
+    deferred_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class IPLease(Base):
+    """
+    Аренда IP-адреса процессом worker: пока срок не истек, адрес обрабатывает
+    только арендатор. done_at — время последнего завершенного обхода.
+    """
+    __tablename__ = 'ip_leases'
+
+    ip_address = Column(String, primary_key=True)
+    worker_id = Column(String)
+    expires_at = Column(DateTime)
+    done_at = Column(DateTime)
+
+class IPCrawlState(Base):
+    __tablename__ = 'ip_crawl_state'
+
+    ip_address = Column(String, primary_key=True)
+    last_crawl_at = Column(DateTime)
+    crawls = Column(Integer, nullable=False, default=0)
+    requests_spent = Column(Integer, nullable=False, default=0)
+    new_domains = Column(Integer, nullable=False, default=0)
+    # Самая поздняя дата разрешения, полученная при обходах (водяной знак)
+    newest_seen_date = Column(DateTime)
+    total_pages = Column(Integer, nullable=False, default=0)
+    # Обход хотя бы раз дошел до конца истории разрешений IP-адреса
+    fully_backfilled = Column(Boolean, nullable=False, default=False)
+
+class ExportState(Base):
+    """
+    Водяной знак инкрементальной выгрузки: пары с added_at не больше
+    watermark уже выгружены.
+    """
+    __tablename__ = 'export_state'
+
+    name = Column(String, primary_key=True)
+    watermark = Column(Integer, nullable=False)
+    exported_at = Column(DateTime, nullable=False)
+    rows = Column(Integer, nullable=False, default=0)
+
+class TelegramOutbox(Base):
+    __tablename__ = 'telegram_outbox'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    chat_id = Column(String, nullable=False)
+    message = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = Column(DateTime)
+    message_id = Column(Integer)
+    failed_at = Column(DateTime)
+    error = Column(Text)
+    # Процесс, который отправляет сообщение, и срок его захвата: сообщение
+    # с истекшим захватом (процесс завершился аварийно) забирает другой процесс
+    sender = Column(String)
+    claimed_until = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_telegram_outbox_pending', 'id',
+              sqlite_where=(delivered_at.is_(None) & failed_at.is_(None))),
+    )
+
+def _set_pragmas(engine, pragmas, immediate=False):
+    """
+    Выполняет PRAGMA на каждом новом соединении движка.
+    :param immediate: Начинать транзакции с BEGIN IMMEDIATE
+    """
+    @event.listens_for(engine.sync_engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        cursor.close()
+        if immediate:
+            # Транзакциями управляет SQLAlchemy через событие begin
+            dbapi_connection.isolation_level = None
+
+    if immediate:
+        # Несколько процессов пишут в один файл: транзакция, начатая чтением, не может
+        # перейти к записи после чужого коммита (SQLITE_BUSY без ожидания busy_timeout),
+        # поэтому блокировка записи берется сразу
+        @event.listens_for(engine.sync_engine, 'begin')
+        def on_begin(connection):
+            connection.exec_driver_sql('BEGIN IMMEDIATE')
 
 class IPDomainDatabaseAsync:
-    def __init__(self, db_path='sqlite+aiosqlite:///data/ip_domains.db'):
-        self.engine = create_async_engine(db_path, echo=False, future=True)
+    def __init__(self, db_path='sqlite+aiosqlite:///data/ip_domains.db', pragmas=None, read_pool_size=4):
+        """
+        Запись идет через одно соединение (движок engine), чтение — через пул
+        соединений только для чтения (read_engine), поэтому поиск не ждет
+        окончания пакетной записи.
+        :param pragmas: PRAGMA соединений вместо SQLITE_PRAGMAS
+        :param read_pool_size: Число соединений чтения; 0 — читать через соединение записи
+        """
+        pragmas = SQLITE_PRAGMAS if pragmas is None else pragmas
+        url = make_url(db_path)
+        in_memory = url.database in (None, '', ':memory:')
+        # Единственное соединение записи: транзакции записи выполняются по очереди
+        pool_options = {} if in_memory else {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': None}
+        self.engine = create_async_engine(url, echo=False, future=True, **pool_options)
+        _set_pragmas(self.engine, pragmas, immediate=not in_memory)
+        if in_memory or not read_pool_size:
+            self.read_engine = self.engine
+        else:
+            read_url = url.set(database=f'file:{url.database}', query={**url.query, 'mode': 'ro', 'uri': 'true'})
+            self.read_engine = create_async_engine(read_url, echo=False, future=True,
+                                                   pool_size=read_pool_size, max_overflow=0, pool_timeout=None)
+            _set_pragmas(self.read_engine, {'query_only': 'ON', **{
+                name: value for name, value in pragmas.items() if name in READER_PRAGMAS
+            }})
         self.AsyncSession = sessionmaker(
             bind=self.engine, class_=AsyncSession, expire_on_commit=False
         )
+        self.ReadSession = sessionmaker(
+            bind=self.read_engine, class_=AsyncSession, expire_on_commit=False
+        )
 
     async def init(self):
         await self.setup_database()
 
     async def setup_database(self):
         async with self.engine.begin() as conn:
-            await conn.run_sync(Base.metadata.create_all)
+            await migrate(conn, Base.metadata)
+
+    async def close(self):
+        await self.engine.dispose()
+        if self.read_engine is not self.engine:
+            await self.read_engine.dispose()
 
-    async def save_data(self, data):
+    @staticmethod
+    async def _lookup_ids(conn, column, values, create=False, extra=None, chunk_size=900):
         """
-        Асинхронное сохранение данных в базу данных.
-        :param data: Словарь с IP-адресами и соответствующими доменами
+        Идентификаторы строк ips или hosts по значениям уникального столбца.
+        :param conn: Соединение или сессия
+        :param column: IP.address или Host.name
+        :param create: Добавить отсутствующие значения
+        :param extra: Функция значение → словарь остальных столбцов добавляемой строки
+        :return: Словарь {значение: id}; без create отсутствующих значений в нем нет
         """
-        async with self.AsyncSession() as session:
-            async with session.begin():
-                for ip_address, domain_list in data.items():
-                    for domain in domain_list:
-                        mapping = IPDomainMapping(
-                            ip_address=ip_address,
-                            host_name=domain['host_name'],
-                            date=datetime.utcfromtimestamp(domain['date'])
-                        )
-                        session.add(mapping)
-                await session.commit()
+        table = column.class_.__table__
+        values = list(dict.fromkeys(values))
+        ids = {}
+        for chunk in chunks(values, chunk_size):
+            if create:
+                await conn.execute(insert(table).on_conflict_do_nothing(index_elements=[column.key]),
+                                   [{column.key: value, **(extra(value) if extra else {})} for value in chunk])
+            result = await conn.execute(select(column, table.c.id).where(column.in_(chunk)))
+            ids.update((value, row_id) for value, row_id in result)
+        return ids
 
-    async def get_latest_dates(self, ip_addresses, if_not_data=False):
+    @timed(DB_QUERY_SECONDS)
+    async def save_data(self, data, chunk_size=1000, update_last_seen=False, outbox=None):
+        """
+        Асинхронное пакетное сохранение данных в базу данных.
+        Уже существующие пары (ip_address, host_name) пропускаются.
+        IP-адреса и имена хостов добавляются в ips и hosts при первом появлении.
+        :param data: Словарь с IP-адресами и Resolutions (или списками словарей с 'host_name' и 'date')
+        :param chunk_size: Количество строк в одном executemany
+        :param update_last_seen: Обновлять last_seen у уже существующих пар
+        :param outbox: Список пар (chat_id, message) для telegram_outbox; записываются
+                       в той же транзакции, что и домены
+        :return: Словарь с количеством добавленных и пропущенных записей
+        """
+        stmt = insert(IPHost).on_conflict_do_nothing(index_elements=['ip_id', 'host_id'])
+        touch = (
+            update(IPHost)
+            .where(IPHost.ip_id == bindparam('b_ip_id'), IPHost.host_id == bindparam('b_host_id'))
+            .values(last_seen=func.max(IPHost.last_seen, bindparam('b_last_seen')))
+        )
+
+        total = inserted = 0
+        added_at = int(datetime.now(timezone.utc).timestamp())
+        async with self.engine.begin() as conn:
+            ip_ids = await self._lookup_ids(conn, IP.address, map(pack_ip, data), create=True)
+            for ip_address, resolutions in data.items():
+                ip_id = ip_ids[pack_ip(ip_address)]
+                for chunk in chunks(as_resolutions(resolutions), chunk_size):
+                    names = [normalize_host(host_name) for host_name, _ in chunk]
+                    host_ids = await self._lookup_ids(
+                        conn, Host.name, names, create=True,
+                        extra=lambda name: {'reversed_name': reverse_host(name)}
+                    )
+                    rows = [{'ip_id': ip_id, 'host_id': host_ids[name], 'first_seen': date, 'last_seen': date,
+                             'added_at': added_at}
+                            for name, (_, date) in zip(names, chunk)]
+                    # Пары, уже бывшие в БД, ON CONFLICT DO NOTHING не считает
+                    inserted += (await conn.execute(stmt, rows)).rowcount
+                    if update_last_seen:
+                        await conn.execute(touch, [
+                            {'b_ip_id': ip_id, 'b_host_id': row['host_id'], 'b_last_seen': row['last_seen']}
+                            for row in rows
+                        ])
+                    total += len(chunk)
+            created_at = datetime.utcnow()
+            for chunk in chunks(outbox or (), chunk_size):
+                await conn.execute(insert(TelegramOutbox), [
+                    {'chat_id': str(chat_id), 'message': message, 'created_at': created_at}
+                    for chat_id, message in chunk
+                ])
+        DB_ROWS.labels('save_data').inc(total)
+        logger.info(f"Saved entries: {inserted}, skipped: {total - inserted}")
+        return {'inserted': inserted, 'skipped': total - inserted}
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_latest_dates(self, ip_addresses, if_not_data=False, chunk_size=900):
         """
         Асинхронное извлечение самой последней даты для каждого IP-адреса из списка.
+        Учитываются и сохраненные домены, и newest_seen_date из ip_crawl_state:
+        IP-адрес без новых доменов не обходится заново до начала истории.
+        Даты извлекаются одним сгруппированным запросом на каждые chunk_size адресов.
         :param ip_addresses: Список IP-адресов
+        :param chunk_size: Количество IP-адресов в одном запросе
         :return: Словарь с последней датой для каждого IP-адреса или False, если данных нет
         """
-        async with self.AsyncSession() as session:
-            latest_dates = {}
-            for ip_address in ip_addresses:
-                # Запрос на извлечение максимальной даты для текущего IP-адреса
+        ip_addresses = list(dict.fromkeys(ip_addresses))
+        DB_ROWS.labels('get_latest_dates').inc(len(ip_addresses))
+        latest_dates = dict.fromkeys(ip_addresses, if_not_data)
+        async with self.ReadSession() as session:
+            for start in range(0, len(ip_addresses), chunk_size):
+                chunk = ip_addresses[start:start + chunk_size]
+                packed = {pack_ip(ip_address): ip_address for ip_address in chunk}
                 result = await session.execute(
-                    select(func.max(IPDomainMapping.date)).where(IPDomainMapping.ip_address == ip_address)
+                    select(IP.address, func.max(IPHost.first_seen))
+                    .join(IPHost, IPHost.ip_id == IP.id)
+                    .where(IP.address.in_(list(packed)))
+                    .group_by(IP.id)
                 )
-                latest_date = result.scalar()
-                # Если данных нет, возвращаем False
-                if latest_date is None:
-                    latest_dates[ip_address] = if_not_data
-                else:
-                    # Конвертируем datetime в Unix timestamp
-                    latest_dates[ip_address] = int(latest_date.timestamp())
+                found = {packed[address]: latest_date for address, latest_date in result}
+                state = await session.execute(
+                    select(IPCrawlState.ip_address, IPCrawlState.newest_seen_date)
+                    .where(IPCrawlState.ip_address.in_(chunk), IPCrawlState.newest_seen_date.is_not(None))
+                )
+                for ip_address, newest_seen_date in state:
+                    timestamp = to_timestamp(newest_seen_date)
+                    found[ip_address] = max(timestamp, found.get(ip_address, timestamp))
+                latest_dates.update(found)
 
             return latest_dates
 
-    async def filter_new_domains(self, transformdata):
+    @timed(DB_QUERY_SECONDS)
+    async def filter_new_domains(self, transformdata, chunk_size=500):
         """
         Filters the domains that are not already in the database with the same IP address.
-        :param transformdata: Dictionary containing IP addresses and their associated domains.
-        :return: Filtered dictionary containing only new entries.
+        Existing pairs are looked up in chunks of host names per IP, repeated pairs
+        inside the batch are kept once.
+        :param transformdata: Dictionary mapping IP addresses to Resolutions.
+        :param chunk_size: Number of host names per IN (...) lookup.
+        :return: Filtered dictionary of Resolutions containing only new entries.
         """
-        async with self.AsyncSession() as session:
+        async with self.ReadSession() as session:
             filtered_data = {}
             existing_count = 0
+            ip_ids = await self._lookup_ids(session, IP.address, map(pack_ip, transformdata))
             for ip_address, entries in transformdata.items():
-                for entry in entries:
-                    host_name = entry['host_name']
-                    result = await session.execute(
-                        select(IPDomainMapping).filter_by(ip_address=ip_address, host_name=host_name)
-                    )
-                    existing_entry = result.scalar()
+                entries = as_resolutions(entries)
+                candidates = Resolutions(map(normalize_host, entries.host_names), entries.dates).unique()
+                host_names = candidates.host_names
+                DB_ROWS.labels('filter_new_domains').inc(len(host_names))
 
-                    if not existing_entry:
-                        if ip_address not in filtered_data:
-                            filtered_data[ip_address] = []
-                        filtered_data[ip_address].append(entry)
-                    else:
-                        existing_count += 1
+                existing = set()
+                # У IP-адреса, которого нет в ips, сохраненных доменов тоже нет
+                ip_id = ip_ids.get(pack_ip(ip_address))
+                if ip_id is not None:
+                    for start in range(0, len(host_names), chunk_size):
+                        result = await session.execute(
+                            select(Host.name)
+                            .join(IPHost, IPHost.host_id == Host.id)
+                            .where(IPHost.ip_id == ip_id, Host.name.in_(host_names[start:start + chunk_size]))
+                        )
+                        existing.update(result.scalars())
+
+                new_entries = candidates.exclude(existing) if existing else candidates
+                if new_entries:
+                    filtered_data[ip_address] = new_entries
+                existing_count += len(existing)
             logger.info(f"Existing entries in DB: {existing_count}")
             logger.info(f"New entries to be added: {sum(len(entries) for entries in filtered_data.values())}")
             return filtered_data
 
+    @timed(DB_QUERY_SECONDS)
+    async def find_ip_by_domains(self, domains, include_subdomains=False, chunk_size=300):
+        """
+        Обратный поиск: IP-адреса, в которые разрешались имена хостов.
+        Точные имена ищутся по уникальному индексу hosts.name, зоны — диапазоном
+        индекса hosts.reversed_name, без просмотра всей таблицы.
+        :param domains: Имена хостов или зоны, тысячи за один вызов
+        :param include_subdomains: Искать также все поддомены каждого имени
+        :param chunk_size: Количество имен в одном запросе
+        :return: Словарь {домен: список словарей с 'ip_address', 'host_name', 'first_seen',
+                 'last_seen'}, новые разрешения первыми; для ненайденных доменов список пуст
+        """
+        domains = list(dict.fromkeys(domains))
+        found = {domain: [] for domain in domains}
+        columns = (IP.address, Host.name, IPHost.first_seen, IPHost.last_seen)
+        async with self.ReadSession() as session:
+            for chunk in chunks(domains, chunk_size):
+                if include_subdomains:
+                    # SQLite не поддерживает VALUES с псевдонимами столбцов во FROM, поэтому CTE
+                    zones = values(column('domain', String), column('low', String), column('high', String),
+                                   name='zones').data([(domain, *zone_range(domain)) for domain in chunk]).cte()
+                    query = (
+                        select(zones.c.domain, *columns)
+                        .select_from(zones)
+                        .join(Host, (Host.reversed_name >= zones.c.low) & (Host.reversed_name < zones.c.high))
+                    )
+                else:
+                    query = (
+                        select(Host.name, *columns)
+                        .select_from(Host)
+                        .where(Host.name.in_({normalize_host(domain) for domain in chunk}))
+                    )
+                result = await session.execute(
+                    query.join(IPHost, IPHost.host_id == Host.id).join(IP, IP.id == IPHost.ip_id)
+                )
+                by_name = {}
+                for key, address, host_name, first_seen, last_seen in result:
+                    by_name.setdefault(key, []).append({
+                        'ip_address': unpack_ip(address),
+                        'host_name': host_name,
+                        'first_seen': datetime.utcfromtimestamp(first_seen),
+                        'last_seen': datetime.utcfromtimestamp(last_seen),
+                    })
+                for domain in chunk:
+                    matches = by_name.get(domain if include_subdomains else normalize_host(domain), [])
+                    found[domain] = sorted(matches, key=lambda match: match['last_seen'], reverse=True)
+        DB_ROWS.labels('find_ip_by_domains').inc(len(domains))
+        return found
+
+    async def stream_mappings(self, networks=(), since=None, until=None, added_after=None, added_until=None,
+                              chunk_size=10000):
+        """
+        Потоковое чтение пар IP-адрес — имя хоста курсором БД: в памяти
+        не больше одной пачки строк при любом размере таблицы.
+        :param networks: Блоки ip_network; пусто — все IP-адреса
+        :param since: Начало окна по first_seen (datetime, UTC) или None
+        :param until: Конец окна по first_seen, не включая, или None
+        :param added_after: Только пары с added_at больше значения (водяной знак) или None
+        :param added_until: Только пары с added_at не больше значения или None
+        :param chunk_size: Количество строк в пачке
+        :return: Асинхронный генератор списков кортежей
+                 (ip_address, host_name, first_seen, last_seen, added_at), даты — UNIX timestamp
+        """
+        query = (
+            select(IP.address, Host.name, IPHost.first_seen, IPHost.last_seen, IPHost.added_at)
+            .select_from(IPHost)
+            .join(IP, IP.id == IPHost.ip_id)
+            .join(Host, Host.id == IPHost.host_id)
+        )
+        if networks:
+            # Упакованные адреса сравниваются побайтно, длина отделяет IPv4 от IPv6
+            query = query.where(or_(*(
+                (func.length(IP.address) == len(network.network_address.packed))
+                & IP.address.between(network.network_address.packed, network.broadcast_address.packed)
+                for network in networks
+            )))
+        if since is not None:
+            query = query.where(IPHost.first_seen >= to_timestamp(since))
+        if until is not None:
+            query = query.where(IPHost.first_seen < to_timestamp(until))
+        if added_after is not None:
+            query = query.where(IPHost.added_at > added_after)
+        if added_until is not None:
+            query = query.where(IPHost.added_at <= added_until)
+
+        # IP-адреса повторяются во многих строках, распаковываются один раз
+        addresses = {}
+        async with self.ReadSession() as session:
+            result = await session.stream(query.execution_options(yield_per=chunk_size))
+            async for partition in result.partitions():
+                rows = []
+                for address, host_name, first_seen, last_seen, added_at in partition:
+                    ip_address = addresses.get(address)
+                    if ip_address is None:
+                        if len(addresses) >= 100000:
+                            addresses.clear()
+                        ip_address = addresses[address] = unpack_ip(address)
+                    rows.append((ip_address, host_name, first_seen, last_seen, added_at))
+                DB_ROWS.labels('stream_mappings').inc(len(rows))
+                yield rows
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_export_watermark(self, name):
+        """
+        :return: Водяной знак выгрузки name или None, если выгрузок еще не было
+        """
+        async with self.ReadSession() as session:
+            result = await session.execute(select(ExportState.watermark).filter_by(name=name))
+            return result.scalar()
+
+    @timed(DB_QUERY_SECONDS)
+    async def set_export_watermark(self, name, watermark, rows):
+        """
+        Сохраняет водяной знак после успешной выгрузки.
+        :param rows: Количество выгруженных строк
+        """
+        stmt = insert(ExportState).values(name=name, watermark=watermark, exported_at=datetime.utcnow(), rows=rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'watermark': stmt.excluded.watermark, 'exported_at': stmt.excluded.exported_at,
+                  'rows': stmt.excluded.rows}
+        )
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_quota_usage(self, key_id, day):
+        """
+        Количество запросов, израсходованных ключом за сутки.
+        :param key_id: Идентификатор ключа API
+        :param day: Сутки в формате YYYY-MM-DD (UTC)
+        :return: Число запросов
+        """
+        async with self.ReadSession() as session:
+            result = await session.execute(
+                select(APIQuotaUsage.requests).filter_by(key_id=key_id, day=day)
+            )
+            return result.scalar() or 0
+
+    @timed(DB_QUERY_SECONDS)
+    async def add_quota_usage(self, key_id, day, count=1):
+        """
+        Увеличивает счетчик израсходованных запросов ключа за сутки.
+        """
+        stmt = insert(APIQuotaUsage).values(key_id=key_id, day=day, requests=count)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['key_id', 'day'],
+            set_={'requests': APIQuotaUsage.requests + stmt.excluded.requests}
+        )
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_pending_ips(self):
+        """
+        IP-адреса, отложенные прошлым запуском (дневной лимит или ошибки).
+        :return: Список IP-адресов в порядке откладывания
+        """
+        async with self.ReadSession() as session:
+            result = await session.execute(
+                select(PendingIP.ip_address).order_by(PendingIP.deferred_at)
+            )
+            return list(result.scalars())
+
+    @timed(DB_QUERY_SECONDS)
+    async def replace_pending_ips(self, ip_addresses):
+        """
+        Заменяет список отложенных IP-адресов.
+        :param ip_addresses: IP-адреса, которые нужно обработать в следующий запуск
+        """
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                await session.execute(delete(PendingIP))
+                session.add_all(PendingIP(ip_address=ip) for ip in dict.fromkeys(ip_addresses))
+
+    @timed(DB_QUERY_SECONDS)
+    async def sync_leases(self, ip_addresses, chunk_size=900):
+        """
+        Приводит таблицу аренды к списку наблюдения одной транзакцией: добавляет
+        новые IP-адреса и удаляет исключенные из списка (в том числе попавшие
+        в список запрета). Состояние остальных аренд не меняется.
+        :param ip_addresses: Итерируемое IP-адресов, читается по частям
+        :return: Кортеж (добавлено, удалено)
+        """
+        async with self.engine.begin() as conn:
+            await conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS watchlist_sync (ip_address TEXT PRIMARY KEY)"))
+            await conn.execute(text("DELETE FROM watchlist_sync"))
+            for chunk in chunks(ip_addresses, chunk_size):
+                await conn.execute(text("INSERT OR IGNORE INTO watchlist_sync (ip_address) VALUES (:ip_address)"),
+                                   [{'ip_address': ip_address} for ip_address in chunk])
+            added = (await conn.execute(text(
+                "INSERT INTO ip_leases (ip_address) SELECT ip_address FROM watchlist_sync WHERE true "
+                "ON CONFLICT (ip_address) DO NOTHING"
+            ))).rowcount
+            removed = (await conn.execute(text(
+                "DELETE FROM ip_leases WHERE ip_address NOT IN (SELECT ip_address FROM watchlist_sync)"
+            ))).rowcount
+            await conn.execute(text("DELETE FROM watchlist_sync"))
+        DB_ROWS.labels('sync_leases').inc(added + removed)
+        return added, removed
+
+    @timed(DB_QUERY_SECONDS)
+    async def claim_leases(self, worker_id, limit, lease_seconds, done_before):
+        """
+        Атомарно берет в аренду свободные IP-адреса: без арендатора или
+        с истекшим сроком аренды (процесс завершился аварийно).
+        :param worker_id: Идентификатор процесса
+        :param limit: Наибольшее число IP-адресов
+        :param lease_seconds: Срок аренды
+        :param done_before: Брать только IP-адреса, обход которых завершен раньше этого времени
+        :return: Список арендованных IP-адресов, сначала ни разу не обойденные
+        """
+        now = datetime.utcnow()
+        free = (
+            select(IPLease.ip_address)
+            .where(or_(IPLease.worker_id.is_(None), IPLease.expires_at < now),
+                   or_(IPLease.done_at.is_(None), IPLease.done_at < done_before))
+            .order_by(IPLease.done_at.is_not(None), IPLease.done_at)
+            .limit(limit)
+        )
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                # Выборка и обновление — одна инструкция внутри BEGIN IMMEDIATE,
+                # поэтому два процесса не получат один IP-адрес
+                result = await session.execute(
+                    update(IPLease)
+                    .where(IPLease.ip_address.in_(free))
+                    .values(worker_id=worker_id, expires_at=now + timedelta(seconds=lease_seconds))
+                    .returning(IPLease.ip_address)
+                    .execution_options(synchronize_session=False)
+                )
+                ip_addresses = list(result.scalars())
+        DB_ROWS.labels('claim_leases').inc(len(ip_addresses))
+        return ip_addresses
+
+    @timed(DB_QUERY_SECONDS)
+    async def renew_leases(self, worker_id, lease_seconds):
+        """
+        Продлевает аренду всех IP-адресов процесса.
+        :return: Количество продленных аренд
+        """
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(IPLease)
+                    .where(IPLease.worker_id == worker_id)
+                    .values(expires_at=datetime.utcnow() + timedelta(seconds=lease_seconds))
+                    .execution_options(synchronize_session=False)
+                )
+                return result.rowcount
+
+    @timed(DB_QUERY_SECONDS)
+    async def count_active_leases(self):
+        """
+        :return: Количество IP-адресов, аренда которых еще не истекла
+        """
+        async with self.ReadSession() as session:
+            result = await session.execute(
+                select(func.count())
+                .select_from(IPLease)
+                .where(IPLease.worker_id.is_not(None), IPLease.expires_at >= datetime.utcnow())
+            )
+            return result.scalar()
+
+    @timed(DB_QUERY_SECONDS)
+    async def release_leases(self, worker_id, ip_addresses, done=True):
+        """
+        Освобождает IP-адреса, которые процесс все еще арендует.
+        :param done: Обход завершен: IP-адрес не выдается повторно до следующего круга
+        :return: Количество освобожденных IP-адресов
+        """
+        changes = {'worker_id': None, 'expires_at': None}
+        if done:
+            changes['done_at'] = datetime.utcnow()
+        released = 0
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                for chunk in chunks(ip_addresses, 900):
+                    result = await session.execute(
+                        update(IPLease)
+                        .where(IPLease.worker_id == worker_id, IPLease.ip_address.in_(chunk))
+                        .values(**changes)
+                        .execution_options(synchronize_session=False)
+                    )
+                    released += result.rowcount
+        return released
+
+    @timed(DB_QUERY_SECONDS)
+    async def save_checkpoint(self, ip_address, entries, cursor):
+        """
+        Сохраняет полученную страницу разрешений IP-адреса.
+        :param entries: Resolutions страницы
+        :param cursor: Курсор следующей страницы или None, если обход завершен
+        """
+        payload = json.dumps(list(as_resolutions(entries)))
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                session.add(CrawlCheckpoint(ip_address=ip_address, cursor=cursor, payload=payload))
+
+    @timed(DB_QUERY_SECONDS)
+    async def load_checkpoint(self, ip_address):
+        """
+        Загружает сохраненные страницы незавершенного обхода IP-адреса.
+        :return: Кортеж (Resolutions, курсор следующей страницы, обход завершен)
+        """
+        async with self.ReadSession() as session:
+            result = await session.execute(
+                select(CrawlCheckpoint.cursor, CrawlCheckpoint.payload)
+                .filter_by(ip_address=ip_address)
+                .order_by(CrawlCheckpoint.id)
+            )
+            entries = Resolutions()
+            cursor = None
+            rows = 0
+            for cursor, payload in result:
+                for host_name, date in json.loads(payload):
+                    entries.append(host_name, date)
+                rows += 1
+            DB_ROWS.labels('load_checkpoint').inc(len(entries))
+            return entries, cursor, bool(rows) and cursor is None
+
+    @timed(DB_QUERY_SECONDS)
+    async def clear_checkpoints(self, ip_addresses):
+        """
+        Удаляет сохраненные страницы IP-адресов, данные которых уже записаны в БД.
+        """
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                for chunk in chunks(ip_addresses, 900):
+                    await session.execute(
+                        delete(CrawlCheckpoint).where(CrawlCheckpoint.ip_address.in_(chunk))
+                    )
+
+    @timed(DB_QUERY_SECONDS)
+    async def update_crawl_state(self, ip_address, requests, new_domains, pages=0,
+                                 newest_seen_date=None, backfilled=False):
+        """
+        Записывает результат завершенного обхода IP-адреса.
+        :param requests: Количество запросов к API за обход
+        :param new_domains: Количество найденных новых доменов
+        :param pages: Количество полученных страниц
+        :param newest_seen_date: Самая поздняя дата разрешения в обходе (UNIX timestamp) или None
+        :param backfilled: Обход дошел до конца истории разрешений
+        """
+        newest = datetime.utcfromtimestamp(newest_seen_date) if newest_seen_date is not None else None
+        stmt = insert(IPCrawlState).values(
+            ip_address=ip_address, last_crawl_at=datetime.utcnow(),
+            crawls=1, requests_spent=requests, new_domains=new_domains,
+            newest_seen_date=newest, total_pages=pages, fully_backfilled=backfilled
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['ip_address'],
+            set_={
+                'last_crawl_at': stmt.excluded.last_crawl_at,
+                'crawls': IPCrawlState.crawls + 1,
+                'requests_spent': IPCrawlState.requests_spent + stmt.excluded.requests_spent,
+                'new_domains': IPCrawlState.new_domains + stmt.excluded.new_domains,
+                # Водяной знак только растет, NULL с любой стороны не затирает дату
+                'newest_seen_date': func.max(
+                    func.coalesce(IPCrawlState.newest_seen_date, stmt.excluded.newest_seen_date),
+                    func.coalesce(stmt.excluded.newest_seen_date, IPCrawlState.newest_seen_date)
+                ),
+                'total_pages': IPCrawlState.total_pages + stmt.excluded.total_pages,
+                'fully_backfilled': func.max(IPCrawlState.fully_backfilled, stmt.excluded.fully_backfilled),
+            }
+        )
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                await session.execute(stmt)
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_ip_stats(self, ip_addresses, since, chunk_size=900):
+        """
+        История IP-адресов для планировщика опроса.
+        :param since: datetime, начало окна для подсчета недавних доменов
+        :return: Словарь {ip: {'recent', 'last_date', 'last_crawl_at', 'crawls', 'requests_spent'}}
+        """
+        ip_addresses = list(dict.fromkeys(ip_addresses))
+        DB_ROWS.labels('get_ip_stats').inc(len(ip_addresses))
+        stats = {
+            ip_address: {'recent': 0, 'last_date': None, 'last_crawl_at': None,
+                         'crawls': 0, 'requests_spent': 0}
+            for ip_address in ip_addresses
+        }
+        since = to_timestamp(since)
+        async with self.ReadSession() as session:
+            for chunk in chunks(ip_addresses, chunk_size):
+                packed = {pack_ip(ip_address): ip_address for ip_address in chunk}
+                result = await session.execute(
+                    select(IP.address,
+                           func.sum(case((IPHost.first_seen >= since, 1), else_=0)),
+                           func.max(IPHost.first_seen))
+                    .join(IPHost, IPHost.ip_id == IP.id)
+                    .where(IP.address.in_(list(packed)))
+                    .group_by(IP.id)
+                )
+                for address, recent, last_date in result:
+                    stats[packed[address]].update(recent=recent, last_date=datetime.utcfromtimestamp(last_date))
+                result = await session.execute(
+                    select(IPCrawlState).where(IPCrawlState.ip_address.in_(chunk))
+                )
+                for state in result.scalars():
+                    stats[state.ip_address].update(
+                        last_crawl_at=state.last_crawl_at, crawls=state.crawls,
+                        requests_spent=state.requests_spent
+                    )
+        return stats
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_backfill_candidates(self, ip_addresses, limit=None, chunk_size=900):
+        """
+        IP-адреса, история разрешений которых еще не получена полностью.
+        :param ip_addresses: Итерируемое IP-адресов без повторов, читается по частям
+        :param limit: Наибольшее число возвращаемых IP-адресов или None
+        :return: Список IP-адресов: сначала без обходов, затем с меньшим числом страниц
+        """
+        candidates = []
+        async with self.ReadSession() as session:
+            for chunk in chunks(ip_addresses, chunk_size):
+                pages = dict.fromkeys(chunk, -1)
+                result = await session.execute(
+                    select(IPCrawlState.ip_address, IPCrawlState.total_pages, IPCrawlState.fully_backfilled)
+                    .where(IPCrawlState.ip_address.in_(chunk))
+                )
+                for ip_address, total_pages, fully_backfilled in result:
+                    if fully_backfilled:
+                        del pages[ip_address]
+                    else:
+                        pages[ip_address] = total_pages
+                candidates.extend((total_pages, ip_address) for ip_address, total_pages in pages.items())
+                DB_ROWS.labels('get_backfill_candidates').inc(len(pages))
+                if limit is not None and len(candidates) > 2 * limit:
+                    candidates = heapq.nsmallest(limit, candidates)
+        return [ip_address for _, ip_address in sorted(candidates)[:limit]]
+
+    @timed(DB_QUERY_SECONDS)
+    async def get_status(self, day):
+        """
+        Сводка состояния БД для команды status.
+        :param day: Сутки квоты в формате YYYY-MM-DD (UTC)
+        :return: Словарь счетчиков, времени последнего обхода и водяных знаков выгрузок
+        """
+        now = datetime.utcnow()
+        async with self.ReadSession() as session:
+            counts = {
+                name: (await session.execute(query)).scalar() or 0
+                for name, query in (
+                    ('ips', select(func.count()).select_from(IP)),
+                    ('hosts', select(func.count()).select_from(Host)),
+                    ('mappings', select(func.count()).select_from(IPHost)),
+                    ('crawled_ips', select(func.count()).select_from(IPCrawlState)),
+                    ('backfilled_ips', select(func.count()).where(IPCrawlState.fully_backfilled)),
+                    ('pending_ips', select(func.count()).select_from(PendingIP)),
+                    ('unfinished_crawls', select(func.count(CrawlCheckpoint.ip_address.distinct()))),
+                    ('active_leases', select(func.count()).where(IPLease.worker_id.is_not(None),
+                                                                 IPLease.expires_at >= now)),
+                    ('outbox_pending', select(func.count()).where(TelegramOutbox.delivered_at.is_(None),
+                                                                  TelegramOutbox.failed_at.is_(None))),
+                    ('outbox_failed', select(func.count()).where(TelegramOutbox.failed_at.is_not(None))),
+                    ('quota_used', select(func.sum(APIQuotaUsage.requests)).filter_by(day=day)),
+                )
+            }
+            last_crawl_at = (await session.execute(select(func.max(IPCrawlState.last_crawl_at)))).scalar()
+            result = await session.execute(
+                select(ExportState.name, ExportState.watermark, ExportState.exported_at, ExportState.rows)
+                .order_by(ExportState.name)
+            )
+            exports = [
+                {'name': name, 'watermark': datetime.utcfromtimestamp(watermark), 'exported_at': exported_at,
+                 'rows': rows}
+                for name, watermark, exported_at, rows in result
+            ]
+        return {**counts, 'last_crawl_at': last_crawl_at, 'exports': exports}
+
+    @timed(DB_QUERY_SECONDS)
+    async def claim_outbox_batch(self, sender, limit=100, claim_seconds=300):
+        """
+        Атомарно захватывает недоставленные сообщения Telegram в порядке добавления:
+        не захваченные или с истекшим сроком захвата. Одно сообщение не
+        захватывают два процесса, поэтому оно не отправляется дважды.
+        :param sender: Идентификатор процесса-отправителя
+        :param claim_seconds: Срок захвата; продлевается renew_outbox_claims
+        :return: Список кортежей (id, chat_id, message)
+        """
+        now = datetime.utcnow()
+        free = (
+            select(TelegramOutbox.id)
+            .where(TelegramOutbox.delivered_at.is_(None),
+                   TelegramOutbox.failed_at.is_(None),
+                   or_(TelegramOutbox.claimed_until.is_(None), TelegramOutbox.claimed_until < now))
+            .order_by(TelegramOutbox.id)
+            .limit(limit)
+        )
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(TelegramOutbox)
+                    .where(TelegramOutbox.id.in_(free))
+                    .values(sender=sender, claimed_until=now + timedelta(seconds=claim_seconds))
+                    .returning(TelegramOutbox.id, TelegramOutbox.chat_id, TelegramOutbox.message)
+                    .execution_options(synchronize_session=False)
+                )
+                rows = sorted(tuple(row) for row in result)
+        DB_ROWS.labels('claim_outbox_batch').inc(len(rows))
+        return rows
+
+    @timed(DB_QUERY_SECONDS)
+    async def renew_outbox_claims(self, sender, claim_seconds=300):
+        """
+        Продлевает захват недоставленных сообщений процесса.
+        :return: Количество продленных захватов
+        """
+        async with self.AsyncSession() as session:
+            async with session.begin():
+                result = await session.execute(
+                    update(TelegramOutbox)
+                    .where(TelegramOutbox.sender == sender,
+                           TelegramOutbox.delivered_at.is_(None),
+                           TelegramOutbox.failed_at.is_(None))
+                    .values(claimed_until=datetime.utcnow() + timedelta(seconds=claim_seconds))
+                    .execution_options(synchronize_session=False)
+                )
+                return result.rowcount
+
+    @timed(DB_QUERY_SECONDS)
+    async def mark_outbox_delivered(self, delivered):
+        """
+        Отмечает сообщения доставленными одной транзакцией.
+        :param delivered: Список пар (id, message_id)
+        """
+        if not delivered:
+            return
+        stmt = (update(TelegramOutbox)
+                .where(TelegramOutbox.id == bindparam('outbox_id'))
+                .values(delivered_at=datetime.utcnow(), message_id=bindparam('sent_id')))
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt, [{'outbox_id': outbox_id, 'sent_id': message_id}
+                                      for outbox_id, message_id in delivered])
+
+    @timed(DB_QUERY_SECONDS)
+    async def mark_outbox_failed(self, failed):
+        """
+        Отмечает сообщения, которые не удалось доставить, одной транзакцией.
+        :param failed: Список пар (id, текст ошибки)
+        """
+        if not failed:
+            return
+        stmt = (update(TelegramOutbox)
+                .where(TelegramOutbox.id == bindparam('outbox_id'))
+                .values(failed_at=datetime.utcnow(), error=bindparam('error_text')))
+        async with self.engine.begin() as conn:
+            await conn.execute(stmt, [{'outbox_id': outbox_id, 'error_text': error}
+                                      for outbox_id, error in failed])
+
 # Пример использования
 async def main():
     db = IPDomainDatabaseAsync()
@@ -127,12 +1005,19 @@ async def main():
 
     domains = ["vernadskogo-circus.online", "nonexistentdomain.com", "example.com"]
     ip_results = await db.find_ip_by_domains(domains)
-    for domain, ip in ip_results.items():
-        if ip:
-            print(f"Домен {domain} принадлежит IP {ip}")
+    for domain, matches in ip_results.items():
+        if matches:
+            for match in matches:
+                print(f"Домен {domain} принадлежит IP {match['ip_address']} (с {match['first_seen']:%Y-%m-%d})")
         else:
             print(f"Домен {domain} не найден в базе")
 
+    # Все поддомены зоны
+    zone_results = await db.find_ip_by_domains(["circus.online"], include_subdomains=True)
+    for zone, matches in zone_results.items():
+        for match in matches:
+            print(f"{match['host_name']} ({zone}) → {match['ip_address']}")
+
     ip_addresses = [
         "89.108.65.169",
         "94.103.183.76"
@@ -0,0 +1,187 @@
+import bz2
+import csv
+import gzip
+import json
+import lzma
+import os
+import sys
+from datetime import datetime, timezone
+
+from messages import logger
+
+COLUMNS = ('ip_address', 'host_name', 'first_seen', 'last_seen')
+# Сжатие текстовых форматов: модуль открытия файла и расширение
+TEXT_COMPRESSION = {'gzip': (gzip.open, '.gz'), 'bz2': (bz2.open, '.bz2'), 'xz': (lzma.open, '.xz')}
+PARQUET_COMPRESSION = ('snappy', 'zstd', 'gzip', 'brotli', 'lz4', 'none')
+# Пары, записанные за последние секунды, могут принадлежать еще не завершенной
+# транзакции, поэтому инкрементальная выгрузка их не берет
+EXPORT_SETTLE_SECONDS = 60
+
+
+def _isoformat(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _open_text(path, compression):
+    if path == '-':
+        if compression:
+            raise ValueError("Сжатие не поддерживается при выводе в стандартный поток")
+        return sys.stdout
+    if compression:
+        opener, _ = TEXT_COMPRESSION[compression]
+        return opener(path, 'wt', encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+class NDJSONWriter:
+    """
+    Объект JSON на строку, даты — ISO 8601 UTC.
+    """
+    def __init__(self, path, compression=None):
+        self.file = _open_text(path, compression)
+
+    def write(self, rows):
+        self.file.write(''.join(
+            json.dumps({'ip_address': ip_address, 'host_name': host_name,
+                        'first_seen': _isoformat(first_seen), 'last_seen': _isoformat(last_seen)},
+                       ensure_ascii=False) + '\n'
+            for ip_address, host_name, first_seen, last_seen, _ in rows
+        ))
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class CSVWriter:
+    """
+    CSV с заголовком, даты — ISO 8601 UTC.
+    """
+    def __init__(self, path, compression=None):
+        self.file = _open_text(path, compression)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(
+            (ip_address, host_name, _isoformat(first_seen), _isoformat(last_seen))
+            for ip_address, host_name, first_seen, last_seen, _ in rows
+        )
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ParquetWriter:
+    """
+    Parquet: каждая пачка строк — отдельная группа строк. Требует pyarrow.
+    """
+    def __init__(self, path, compression=None):
+        """
+        :param compression: Кодек pyarrow, 'none' — без сжатия, None — snappy
+        """
+        if path == '-':
+            raise ValueError("Parquet нельзя вывести в стандартный поток")
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Для выгрузки в Parquet установите pyarrow: poetry run pip install pyarrow") from None
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            ('ip_address', pyarrow.string()),
+            ('host_name', pyarrow.string()),
+            ('first_seen', pyarrow.timestamp('s', tz='UTC')),
+            ('last_seen', pyarrow.timestamp('s', tz='UTC')),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression=compression or 'snappy')
+
+    def write(self, rows):
+        ip_addresses, host_names, first_seen, last_seen, _ = zip(*rows)
+        self.writer.write_table(self.pyarrow.Table.from_arrays(
+            [self.pyarrow.array(ip_addresses), self.pyarrow.array(host_names),
+             self.pyarrow.array(first_seen, self.schema.field('first_seen').type),
+             self.pyarrow.array(last_seen, self.schema.field('last_seen').type)],
+            schema=self.schema,
+        ))
+
+    def close(self):
+        self.writer.close()
+
+
+WRITERS = {'ndjson': NDJSONWriter, 'csv': CSVWriter, 'parquet': ParquetWriter}
+
+
+def guess_format(path):
+    """
+    Формат и сжатие по расширению файла: data.ndjson.gz → ('ndjson', 'gzip').
+    :return: Кортеж (формат или None, сжатие или None)
+    """
+    compression = None
+    for name, (_, suffix) in TEXT_COMPRESSION.items():
+        if path.endswith(suffix):
+            compression = name
+            path = path[:-len(suffix)]
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    extension = {'jsonl': 'ndjson', 'json': 'ndjson', 'pq': 'parquet'}.get(extension, extension)
+    return (extension if extension in WRITERS else None), compression
+
+
+async def export_mappings(db, path, fmt=None, compression=None, networks=(), since=None, until=None,
+                          incremental=None, chunk_size=10000):
+    """
+    Выгружает пары IP-адрес — имя хоста из БД в файл потоково, пачками по chunk_size строк.
+    Файл пишется под временным именем и переименовывается после записи последней пачки.
+    :param db: IPDomainDatabaseAsync
+    :param path: Путь к файлу или '-' (стандартный вывод, только ndjson и csv)
+    :param fmt: 'ndjson', 'csv' или 'parquet'; по умолчанию — по расширению path
+    :param compression: gzip, bz2, xz для ndjson и csv; snappy, zstd, ... для parquet
+    :param networks: Блоки ip_network для отбора IP-адресов
+    :param since: Начало окна по first_seen (datetime, UTC) или None
+    :param until: Конец окна по first_seen, не включая, или None
+    :param incremental: Имя водяного знака: выгрузить только пары, записанные после
+                        прошлой выгрузки с этим именем, и сдвинуть водяной знак
+    :return: Количество выгруженных строк
+    """
+    guessed_format, guessed_compression = guess_format(path) if path != '-' else (None, None)
+    fmt = fmt or guessed_format or 'ndjson'
+    if fmt not in WRITERS:
+        raise ValueError(f"Неизвестный формат {fmt}, доступны: {', '.join(WRITERS)}")
+    compression = compression or (guessed_compression if fmt != 'parquet' else None)
+    # Для текстовых форматов 'none' — без сжатия; в Parquet передается как есть,
+    # а None означает сжатие по умолчанию (snappy)
+    if compression == 'none' and fmt != 'parquet':
+        compression = None
+    if compression and fmt != 'parquet' and compression not in TEXT_COMPRESSION:
+        raise ValueError(f"Сжатие {compression} не поддерживается для {fmt}: {', '.join(TEXT_COMPRESSION)}")
+    if compression and fmt == 'parquet' and compression not in PARQUET_COMPRESSION:
+        raise ValueError(f"Сжатие {compression} не поддерживается для parquet: {', '.join(PARQUET_COMPRESSION)}")
+
+    added_after = added_until = None
+    if incremental:
+        added_after = await db.get_export_watermark(incremental)
+        added_until = int(datetime.now(timezone.utc).timestamp()) - EXPORT_SETTLE_SECONDS
+        if added_after is not None:
+            added_until = max(added_until, added_after)
+
+    target = path if path == '-' else f"{path}.part"
+    writer = WRITERS[fmt](target, compression)
+    rows = 0
+    try:
+        async for chunk in db.stream_mappings(networks, since=since, until=until, added_after=added_after,
+                                              added_until=added_until, chunk_size=chunk_size):
+            writer.write(chunk)
+            rows += len(chunk)
+    except BaseException:
+        writer.close()
+        if target != path:
+            os.remove(target)
+        raise
+    writer.close()
+    if target != path:
+        os.replace(target, path)
+    if incremental:
+        await db.set_export_watermark(incremental, added_until, rows)
+    logger.info(f"Выгружено строк: {rows} в {path} ({fmt}{f', {compression}' if compression else ''})")
+    return rows
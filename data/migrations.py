@@ -0,0 +1,155 @@
+import ipaddress
+
+from sqlalchemy import inspect, text
+
+from messages import logger
+
+def add_columns(table, columns):
+    """
+    Шаг миграции: добавляет недостающие столбцы. Таблица могла быть только что
+    создана create_all уже с этими столбцами, поэтому существующие пропускаются.
+    :param columns: Словарь {имя столбца: определение для ALTER TABLE}
+    """
+    def step(sync_conn):
+        existing = {column['name'] for column in inspect(sync_conn).get_columns(table)}
+        for name, definition in columns.items():
+            if name not in existing:
+                sync_conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+    return step
+
+
+def normalize_mappings(sync_conn):
+    """
+    Переносит ip_domain_mappings в ips, hosts и ip_hosts. IP-адреса упаковываются
+    в Python, остальное выполняется запросами внутри SQLite.
+    """
+    sync_conn.execute(text("CREATE TEMP TABLE ip_map (ip_address TEXT PRIMARY KEY, ip_id INTEGER NOT NULL)"))
+    ip_addresses = sync_conn.execute(text("SELECT DISTINCT ip_address FROM ip_domain_mappings")).scalars().all()
+    for ip_address in ip_addresses:
+        try:
+            packed = ipaddress.ip_address(ip_address.strip()).packed
+        except ValueError:
+            logger.warning(f"Миграция: строки с некорректным IP-адресом {ip_address!r} пропущены")
+            continue
+        sync_conn.execute(text("INSERT INTO ips (address) VALUES (:address) ON CONFLICT (address) DO NOTHING"),
+                          {'address': packed})
+        sync_conn.execute(text("INSERT INTO ip_map (ip_address, ip_id) "
+                               "SELECT :ip_address, id FROM ips WHERE address = :address"),
+                          {'ip_address': ip_address, 'address': packed})
+    # Имя хоста приводится так же, как normalize_host
+    host_name = "lower(rtrim(trim(d.host_name), '.'))"
+    sync_conn.execute(text(f"INSERT OR IGNORE INTO hosts (name) SELECT DISTINCT {host_name} FROM ip_domain_mappings d"))
+    sync_conn.execute(text(
+        "INSERT OR IGNORE INTO ip_hosts (ip_id, host_id, first_seen, last_seen) "
+        "SELECT m.ip_id, h.id, MIN(CAST(strftime('%s', d.date) AS INTEGER)), "
+        "MAX(CAST(strftime('%s', COALESCE(d.last_seen, d.date)) AS INTEGER)) "
+        "FROM ip_domain_mappings d "
+        "JOIN ip_map m ON m.ip_address = d.ip_address "
+        f"JOIN hosts h ON h.name = {host_name} "
+        "GROUP BY m.ip_id, h.id"
+    ))
+    sync_conn.execute(text("DROP TABLE ip_map"))
+    sync_conn.execute(text("DROP TABLE ip_domain_mappings"))
+    logger.info("Таблица ip_domain_mappings перенесена в ips, hosts и ip_hosts; "
+                "чтобы уменьшить файл БД, выполните VACUUM")
+
+
+def fill_reversed_names(sync_conn, chunk_size=10000):
+    """
+    Заполняет hosts.reversed_name (метки имени в обратном порядке, как reverse_host).
+    """
+    while rows := sync_conn.execute(text(
+        "SELECT id, name FROM hosts WHERE reversed_name IS NULL LIMIT :limit"
+    ), {'limit': chunk_size}).all():
+        sync_conn.execute(
+            text("UPDATE hosts SET reversed_name = :reversed_name WHERE id = :id"),
+            [{'id': host_id, 'reversed_name': '.'.join(reversed(name.split('.'))) + '.'}
+             for host_id, name in rows]
+        )
+
+
+# Миграции существующих баз. Номер миграции — позиция в списке,
+# примененная версия хранится в PRAGMA user_version.
+# Шаг миграции — SQL-запрос или функция от синхронного соединения.
+MIGRATIONS = [
+    # 1: уникальность пары (ip_address, host_name), дубликаты удаляются. Оставшаяся
+    # строка получает самую раннюю дату пары, а самая поздняя переносится в last_seen
+    [
+        add_columns('ip_domain_mappings', {'last_seen': 'DATETIME'}),
+        "UPDATE ip_domain_mappings SET date = g.first_date, last_seen = g.last_date FROM "
+        "(SELECT MIN(id) AS id, MIN(date) AS first_date, MAX(COALESCE(last_seen, date)) AS last_date "
+        "FROM ip_domain_mappings GROUP BY ip_address, host_name HAVING COUNT(*) > 1) AS g "
+        "WHERE ip_domain_mappings.id = g.id",
+        "DELETE FROM ip_domain_mappings WHERE id NOT IN "
+        "(SELECT MIN(id) FROM ip_domain_mappings GROUP BY ip_address, host_name)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_ip_domain_mappings_ip_host "
+        "ON ip_domain_mappings (ip_address, host_name)",
+    ],
+    # 2: индекс для поиска последней даты по IP
+    [
+        "CREATE INDEX IF NOT EXISTS ix_ip_domain_mappings_ip_date "
+        "ON ip_domain_mappings (ip_address, date)",
+    ],
+    # 3: дата последнего появления пары (у повторявшихся пар заполнена миграцией 1)
+    [
+        add_columns('ip_domain_mappings', {'last_seen': 'DATETIME'}),
+        "UPDATE ip_domain_mappings SET last_seen = date WHERE last_seen IS NULL",
+    ],
+    # 4: водяной знак, число страниц и признак полной истории в ip_crawl_state
+    [
+        add_columns('ip_crawl_state', {
+            'newest_seen_date': 'DATETIME',
+            'total_pages': 'INTEGER NOT NULL DEFAULT 0',
+            'fully_backfilled': 'BOOLEAN NOT NULL DEFAULT 0',
+        }),
+        "INSERT INTO ip_crawl_state (ip_address, crawls, requests_spent, new_domains, "
+        "newest_seen_date, total_pages, fully_backfilled) "
+        "SELECT ip_address, 0, 0, 0, MAX(last_seen), 0, 0 FROM ip_domain_mappings WHERE true "
+        "GROUP BY ip_address "
+        "ON CONFLICT (ip_address) DO UPDATE SET newest_seen_date = excluded.newest_seen_date",
+    ],
+    # 5: нормализованная схема: IP-адреса и имена хостов в отдельных таблицах
+    [
+        normalize_mappings,
+    ],
+    # 6: обратный поиск IP-адресов по имени хоста и зоне
+    [
+        add_columns('hosts', {'reversed_name': 'VARCHAR'}),
+        fill_reversed_names,
+        "CREATE INDEX IF NOT EXISTS ix_hosts_reversed_name ON hosts (reversed_name)",
+        "CREATE INDEX IF NOT EXISTS ix_ip_hosts_host ON ip_hosts (host_id)",
+    ],
+    # 7: время записи пары для инкрементальной выгрузки
+    [
+        add_columns('ip_hosts', {'added_at': 'INTEGER NOT NULL DEFAULT 0'}),
+        "CREATE INDEX IF NOT EXISTS ix_ip_hosts_added_at ON ip_hosts (added_at)",
+    ],
+    # 8: захват сообщений telegram_outbox процессом-отправителем
+    [
+        add_columns('telegram_outbox', {'sender': 'VARCHAR', 'claimed_until': 'DATETIME'}),
+    ],
+]
+
+
+async def migrate(conn, metadata):
+    """
+    Создает недостающие таблицы и применяет к базе недостающие миграции.
+    Новая база сразу создается по текущей схеме и помечается последней версией.
+    :param conn: Асинхронное соединение SQLAlchemy внутри транзакции
+    :param metadata: Метаданные моделей
+    """
+    tables = await conn.run_sync(lambda sync_conn: inspect(sync_conn).get_table_names())
+    await conn.run_sync(metadata.create_all)
+    if not tables:
+        await conn.execute(text(f'PRAGMA user_version = {len(MIGRATIONS)}'))
+        return
+
+    version = (await conn.execute(text('PRAGMA user_version'))).scalar()
+    for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+        for statement in statements:
+            if callable(statement):
+                await conn.run_sync(statement)
+            else:
+                await conn.execute(text(statement))
+        await conn.execute(text(f'PRAGMA user_version = {number}'))
+        logger.info(f"Применена миграция БД №{number}")
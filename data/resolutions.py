@@ -0,0 +1,102 @@
+import sys
+from array import array
+
+
+class Resolutions:
+    """
+    Разрешения одного IP-адреса в компактном виде: параллельные массивы
+    имен хостов (интернированные строки) и дат (array int64, UNIX timestamp).
+    Вместо словаря на каждую запись хранится одна ссылка и 8 байт даты,
+    а одинаковые имена хостов разных IP-адресов — одной строкой.
+    """
+    __slots__ = ('host_names', 'dates')
+
+    def __init__(self, host_names=(), dates=()):
+        self.host_names = [sys.intern(host_name) for host_name in host_names]
+        self.dates = array('q', dates)
+
+    @classmethod
+    def from_records(cls, records):
+        """
+        :param records: Итерируемое словарей с 'host_name' и 'date' или пар (host_name, date)
+        """
+        resolutions = cls()
+        for record in records:
+            if isinstance(record, dict):
+                resolutions.append(record['host_name'], record['date'])
+            else:
+                resolutions.append(*record)
+        return resolutions
+
+    def append(self, host_name, date):
+        self.host_names.append(sys.intern(host_name))
+        self.dates.append(int(date))
+
+    def extend(self, other):
+        self.host_names.extend(other.host_names)
+        self.dates.extend(other.dates)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __iter__(self):
+        """
+        :return: Пары (host_name, date)
+        """
+        return zip(self.host_names, self.dates)
+
+    def __eq__(self, other):
+        if not isinstance(other, Resolutions):
+            return NotImplemented
+        return self.host_names == other.host_names and self.dates == other.dates
+
+    def __repr__(self):
+        return f"Resolutions({len(self)} records)"
+
+    def min_date(self):
+        return min(self.dates)
+
+    def max_date(self):
+        return max(self.dates)
+
+    def unique(self):
+        """
+        :return: Resolutions с первой записью каждого имени хоста
+        """
+        first = {}
+        for index, host_name in enumerate(self.host_names):
+            first.setdefault(host_name, index)
+        return self.take(first.values())
+
+    def take(self, indexes):
+        """
+        :return: Resolutions из записей с указанными номерами
+        """
+        result = Resolutions()
+        for index in indexes:
+            result.host_names.append(self.host_names[index])
+            result.dates.append(self.dates[index])
+        return result
+
+    def exclude(self, host_names):
+        """
+        :return: Resolutions без записей с именами хостов из host_names
+        """
+        return self.take(index for index, host_name in enumerate(self.host_names)
+                         if host_name not in host_names)
+
+    def to_records(self):
+        """
+        :return: Список словарей с 'host_name' и 'date' (для JSON)
+        """
+        return [{'host_name': host_name, 'date': date} for host_name, date in self]
+
+
+def as_resolutions(entries):
+    """
+    Приводит список словарей с 'host_name' и 'date' к Resolutions.
+    Resolutions возвращается без копирования.
+    """
+    if isinstance(entries, Resolutions):
+        return entries
+    return Resolutions.from_records(entries)
@@ -0,0 +1,141 @@
+import ipaddress
+import json
+
+import aiofiles
+
+from messages import logger
+
+# Больше адресов в одной записи списка наблюдения не разворачивается:
+# ошибочный /8 или IPv6 /64 исчерпал бы весь бюджет запросов
+MAX_ENTRY_ADDRESSES = 2 ** 20
+
+
+def parse_entry(entry, hosts_only=True):
+    """
+    Разбирает запись списка IP-адресов: адрес, блок CIDR или диапазон 'от-до'.
+    :param hosts_only: Не включать адрес сети и широковещательный адрес блоков IPv4
+    :return: Список ip_network, покрывающих запись
+    :raises ValueError: если запись не является адресом, блоком или диапазоном
+    """
+    if '-' in entry:
+        first, last = (ipaddress.ip_address(part.strip()) for part in entry.split('-', 1))
+        if first.version != last.version or first > last:
+            raise ValueError(f"неверный диапазон {entry}")
+        return list(ipaddress.summarize_address_range(first, last))
+    if '/' in entry:
+        network = ipaddress.ip_network(entry, strict=False)
+        if hosts_only and network.version == 4 and network.prefixlen < 31:
+            return list(ipaddress.summarize_address_range(network.network_address + 1,
+                                                          network.broadcast_address - 1))
+        return [network]
+    return [ipaddress.ip_network(ipaddress.ip_address(entry))]
+
+
+def _subtract(network, denied):
+    """
+    :return: Части network, не входящие ни в один блок denied той же версии
+    """
+    for deny in denied:
+        if network.subnet_of(deny):
+            return []
+        if deny.subnet_of(network):
+            return [part for rest in network.address_exclude(deny) for part in _subtract(rest, denied)]
+    return [network]
+
+
+class Watchlist:
+    """
+    Список наблюдаемых IP-адресов в виде свернутых блоков. Пересекающиеся
+    и повторяющиеся записи объединяются при загрузке, поэтому адреса
+    разворачиваются лениво и без повторов: каждый обход списка — генератор,
+    и /16 не превращается в список из 65 тысяч строк.
+    """
+    def __init__(self, networks=(), denied=()):
+        """
+        :param networks: Блоки ip_network наблюдаемых адресов
+        :param denied: Блоки ip_network, исключаемые из списка
+        """
+        self.networks = []
+        for version in (4, 6):
+            deny = list(ipaddress.collapse_addresses(n for n in denied if n.version == version))
+            for network in ipaddress.collapse_addresses(n for n in networks if n.version == version):
+                self.networks.extend(_subtract(network, deny))
+        self.networks.sort(key=lambda network: (network.version, network))
+
+    def __iter__(self):
+        for network in self.networks:
+            for ip_address in network:
+                yield str(ip_address)
+
+    def __len__(self):
+        return sum(network.num_addresses for network in self.networks)
+
+    def __repr__(self):
+        return f"Watchlist({len(self.networks)} networks, {len(self)} addresses)"
+
+
+async def iter_entries(file_path):
+    """
+    Записи файла IP-адресов: JSON-список строк или по одной записи в строке.
+    В построчном формате пустые строки и комментарии '#' пропускаются.
+    :return: Асинхронный генератор пар (номер записи, запись)
+    """
+    async with aiofiles.open(file_path, mode='r', encoding='utf-8') as file:
+        # Формат определяется по первому непробельному символу файла
+        leading = []
+        line = await file.readline()
+        while line and not line.strip():
+            leading.append(line)
+            line = await file.readline()
+        if line.lstrip().startswith('['):
+            entries = json.loads(''.join(leading) + line + await file.read())
+            for number, entry in enumerate(entries, 1):
+                yield number, entry
+            return
+        number = len(leading) + 1
+        while line:
+            entry = line.split('#', 1)[0].strip()
+            if entry:
+                yield number, entry
+            number += 1
+            line = await file.readline()
+
+
+async def read_networks(file_path, hosts_only=True, max_addresses=None):
+    """
+    Читает и проверяет записи файла за один проход. Неверные записи
+    пропускаются с предупреждением.
+    :param max_addresses: Наибольшее число адресов в одной записи или None
+    :return: Список ip_network
+    """
+    networks = []
+    async for number, entry in iter_entries(file_path):
+        try:
+            if not isinstance(entry, str):
+                raise ValueError(f"ожидалась строка, получено {entry!r}")
+            parsed = parse_entry(entry.strip(), hosts_only=hosts_only)
+        except ValueError as error:
+            logger.warning(f"{file_path}:{number}: запись {entry!r} пропущена: {error}")
+            continue
+        size = sum(network.num_addresses for network in parsed)
+        if max_addresses is not None and size > max_addresses:
+            logger.warning(f"{file_path}:{number}: запись {entry!r} пропущена: "
+                           f"{size} адресов, допустимо не больше {max_addresses}")
+            continue
+        networks.extend(parsed)
+    return networks
+
+
+async def load_watchlist(file_path, denylist_path=None, max_addresses=MAX_ENTRY_ADDRESSES):
+    """
+    Загружает список наблюдения.
+    :param file_path: Файл IP-адресов, блоков CIDR и диапазонов
+    :param denylist_path: Файл исключаемых адресов и блоков в том же формате или None
+    :param max_addresses: Наибольшее число адресов в одной записи
+    :return: Watchlist
+    """
+    networks = await read_networks(file_path, max_addresses=max_addresses)
+    denied = await read_networks(denylist_path, hosts_only=False) if denylist_path else ()
+    watchlist = Watchlist(networks, denied)
+    logger.info(f"Список наблюдения {file_path}: {len(watchlist)} IP-адресов в {len(watchlist.networks)} блоках")
+    return watchlist
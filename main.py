@@ -1,44 +1,350 @@
+import argparse
 import asyncio
 import os
 import json
+import sys
+from datetime import datetime, timezone
 from dotenv import load_dotenv
 
-from data import (read_ip_addresses,
-                  transform_ip_resolutions,
-                  save_data_as_json)
-from data.database_manager import IPDomainDatabaseAsync
-from request import Request
-from messages import generate_telegram_messages, logger
-from tg import TelegramBot
+# Подсистемы импортируются внутри команд: короткие команды (status, lookup, export)
+# не загружают клиенты VirusTotal и Telegram и запускаются быстро
 
 load_dotenv()
 # Установить рабочую директорию в директорию, где находится скрипт
 LAST_DATA_CHECK = 1723056400
 DEBUG = False
-VT_API_KEY = os.getenv('VT_API_KEY')
+# Несколько ключей перечисляются через запятую в VT_API_KEYS
+VT_API_KEYS = [key.strip() for key in os.getenv('VT_API_KEYS', os.getenv('VT_API_KEY', '')).split(',')]
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_API_TOKEN')
 TELEGRAM_CHANNEL_ID = os.getenv('TELEGRAM_CHANNEL_INFO')
+# Интервал между циклами в режиме демона, минуты
+DAEMON_INTERVAL = int(os.getenv('DAEMON_INTERVAL_MINUTES', 30))
+# Каждый IP-адрес опрашивается не реже, чем раз в столько часов
+MAX_POLL_INTERVAL = int(os.getenv('MAX_POLL_INTERVAL_HOURS', 168))
+# Доля бюджета запуска на получение полной истории новых IP-адресов
+BACKFILL_SHARE = float(os.getenv('BACKFILL_SHARE', 0.2))
+# Лимиты ключа VirusTotal (по умолчанию — бесплатный ключ)
+VT_LIMITS = {'per_minute': int(os.getenv('VT_REQUESTS_PER_MINUTE', 4)),
+             'in_a_day': int(os.getenv('VT_REQUESTS_PER_DAY', 500))}
+# Адреса API и пути к данным переопределяются, например, бенчмарком
+VT_API_HOST = os.getenv('VT_API_HOST')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+TELEGRAM_CHAT_PER_MINUTE = int(os.getenv('TELEGRAM_CHAT_PER_MINUTE', 20))
+DB_URL = os.getenv('DB_URL', 'sqlite+aiosqlite:///data/ip_domains.db')
+IP_ADDRESSES_FILE = os.getenv('IP_ADDRESSES_FILE', 'data/ip_addresses.json')
+# Адреса и блоки, которые не опрашиваются, даже если входят в блоки списка наблюдения
+IP_DENYLIST_FILE = os.getenv('IP_DENYLIST_FILE')
+# Демон отдает метрики по HTTP, однократный запуск пишет их снимок в файл
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))
+METRICS_SNAPSHOT = os.getenv('METRICS_SNAPSHOT', 'data/metrics.json')
+# Профилирование одного этапа (fetch, save, send, ...): cprofile или sampler
+PROFILE_STAGE = os.getenv('PROFILE_STAGE')
+PROFILE_MODE = os.getenv('PROFILE_MODE', 'cprofile')
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'data/profiles')
 
-request = Request(VT_API_KEY)
-DB = IPDomainDatabaseAsync()
-async def main():
-    await DB.init()
+# Режим worker: несколько процессов делят список наблюдения через аренду IP-адресов
+WORKER_BATCH_SIZE = int(os.getenv('WORKER_BATCH_SIZE', 20))
+WORKER_LEASE_SECONDS = int(os.getenv('WORKER_LEASE_SECONDS', 300))
+
+def make_db():
+    from data.database_manager import IPDomainDatabaseAsync
+    return IPDomainDatabaseAsync(DB_URL)
+
+def make_request(db):
+    from request import Request
+    return Request(VT_API_KEYS, quota_store=db, checkpoint_store=db, limits=VT_LIMITS, host=VT_API_HOST)
+
+def make_planner(db):
+    from planner import Planner
+    return Planner(db, max_interval_hours=MAX_POLL_INTERVAL)
 
-    ip_addresses: list = await read_ip_addresses()
-    ip_addresses = await DB.get_latest_dates(ip_addresses, if_not_data=LAST_DATA_CHECK)
+async def run_once(request, db, planner, outbox, budget=None):
+    """
+    Один цикл обработки списка IP-адресов.
+    :param outbox: Открытый OutboxSender
+    :param budget: Бюджет запросов к API на цикл или None
+    """
+    from data import read_ip_addresses
+    from messages import logger
+    from metrics import span
+    from pipeline import run_pipeline
+
+    with span('read_watchlist'):
+        watchlist = await read_ip_addresses(IP_ADDRESSES_FILE, IP_DENYLIST_FILE)
+    if budget is None:
+        budget = await request.pool.remaining()
+    backfill_budget = int(budget * BACKFILL_SHARE)
+    with span('plan'):
+        # IP-адреса, отложенные прошлым запуском, опрашиваются в первую очередь
+        ip_addresses = await planner.plan(watchlist, budget - backfill_budget, priority=await db.get_pending_ips())
+    with span('watermarks'):
+        ip_addresses = await db.get_latest_dates(ip_addresses, if_not_data=LAST_DATA_CHECK)
     logger.info(f'Checking this {ip_addresses}')
 
-    ip_resolutions = await request.fetch_domains_by_ip_addresses(ip_addresses)
-    transform_ip_resolutions_ = transform_ip_resolutions(ip_resolutions)
-    new_domains = await DB.filter_new_domains(transform_ip_resolutions_)
+    request.pool.set_budget(budget - backfill_budget)
+    request.ip_requests.clear()
+    stats = await run_pipeline(request, db, outbox, ip_addresses, debug=DEBUG)
+    planner.report(stats['yield'], request.ip_requests)
+
+    await db.replace_pending_ips(request.deferred)
+    if request.deferred:
+        logger.warning(f"Перенесено на следующий запуск: {request.deferred}")
+
+    # Неизрасходованный остаток обычного обхода тоже уходит на историю
+    await run_backfill(request, db, outbox, watchlist, budget - request.pool.spent)
+
+async def run_backfill(request, db, outbox, watchlist, budget):
+    """
+    Получает полную историю разрешений IP-адресов, для которых ее еще нет.
+    Домены старше последней известной даты IP-адреса сохраняются без уведомлений
+    в Telegram, о более новых уведомления отправляются. Незавершенный обход
+    продолжается со своей страницы при следующем запуске.
+    :param budget: Бюджет запросов на обход истории
+    """
+    from messages import logger
+    from metrics import span
+    from pipeline import run_pipeline
+
+    if budget <= 0 or request.pool.stopped:
+        return
+    with span('backfill_plan'):
+        # Каждому IP-адресу нужен хотя бы один запрос
+        ip_addresses = await db.get_backfill_candidates(watchlist, limit=budget)
+    if not ip_addresses:
+        return
+    logger.info(f"Получение истории {len(ip_addresses)} IP-адресов, бюджет запросов: {budget}")
+    request.pool.set_budget(budget)
+    request.ip_requests.clear()
+    # Водяные знаки только для уведомлений: обход истории идет с первой страницы
+    watermarks = await db.get_latest_dates(ip_addresses)
+    with span('backfill'):
+        await run_pipeline(request, db, outbox, dict.fromkeys(ip_addresses, False), debug=DEBUG, backfill=True,
+                           watermarks=watermarks)
+
+def start_profiling():
+    from metrics import TRACER
+    if PROFILE_STAGE:
+        TRACER.configure_profiler(PROFILE_STAGE, PROFILE_MODE, PROFILE_DIR)
+
+async def finish_profiling():
+    from messages import logger
+    from metrics import TRACER
+    await TRACER.finish()
+    logger.info("Время по этапам:\n" + TRACER.format_table())
+
+def make_bot():
+    from tg import TelegramBot
+    return TelegramBot(TELEGRAM_TOKEN, TELEGRAM_CHANNEL_ID, queue_size=100,
+                       chat_per_minute=TELEGRAM_CHAT_PER_MINUTE, api_url=TELEGRAM_API_URL)
+
+async def main():
+    from metrics import REGISTRY
+    from tg import OutboxSender
+
+    db = make_db()
+    request = make_request(db)
+    await db.init()
+    start_profiling()
+    try:
+        async with make_bot() as bot, OutboxSender(bot, db) as outbox:
+            await run_once(request, db, make_planner(db), outbox)
+    finally:
+        REGISTRY.write_snapshot(METRICS_SNAPSHOT)
+        await finish_profiling()
+        await db.close()
+
+async def run_daemon():
+    from daemon import Daemon
+    from metrics import start_metrics_server
+    from tg import OutboxSender
+
+    db = make_db()
+    request = make_request(db)
+    planner = make_planner(db)
+    await db.init()
+    metrics_server = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    start_profiling()
+    # Клиенты VirusTotal, движок БД и сессия Telegram живут все время работы
+    async with request.pool, make_bot() as bot, OutboxSender(bot, db) as outbox:
+        await Daemon(request, lambda budget: run_once(request, db, planner, outbox, budget),
+                     interval=DAEMON_INTERVAL * 60).run()
+    metrics_server.close()
+    await metrics_server.wait_closed()
+    await finish_profiling()
+    await db.close()
+
+async def run_batch(request, db, outbox, batch, on_saved):
+    """
+    Обрабатывает пакет арендованных IP-адресов.
+    :param on_saved: Вызывается с IP-адресом после записи его результатов
+    """
+    from pipeline import run_pipeline
+
+    ip_addresses = await db.get_latest_dates(batch, if_not_data=LAST_DATA_CHECK)
+    request.pool.set_budget(await request.pool.remaining())
+    request.ip_requests.clear()
+    await run_pipeline(request, db, outbox, ip_addresses, debug=DEBUG, on_saved=on_saved)
+
+async def run_worker(once=False):
+    from daemon import Worker
+    from data import read_ip_addresses
+    from metrics import REGISTRY
+    from tg import OutboxSender
+
+    db = make_db()
+    request = make_request(db)
+    await db.init()
+    start_profiling()
+    try:
+        async with request.pool, make_bot() as bot, OutboxSender(bot, db) as outbox:
+            worker = Worker(request, db, lambda batch, on_saved: run_batch(request, db, outbox, batch, on_saved),
+                            batch_size=WORKER_BATCH_SIZE, lease_seconds=WORKER_LEASE_SECONDS,
+                            recrawl_seconds=DAEMON_INTERVAL * 60)
+            await worker.run(lambda: read_ip_addresses(IP_ADDRESSES_FILE, IP_DENYLIST_FILE), once=once)
+    finally:
+        REGISTRY.write_snapshot(METRICS_SNAPSHOT)
+        await finish_profiling()
+        await db.close()
+
+async def status(as_json=False):
+    """
+    Выводит размер списка наблюдения, содержимое БД, расход квоты за сутки,
+    очередь Telegram и водяные знаки выгрузок. Не обращается к API.
+    :param as_json: Вывести JSON вместо текста
+    """
+    from data import read_ip_addresses
+
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    db = make_db()
+    await db.init()
+    try:
+        summary = await db.get_status(day)
+    finally:
+        await db.close()
+    watchlist = None
+    if os.path.exists(IP_ADDRESSES_FILE):
+        watchlist = len(await read_ip_addresses(IP_ADDRESSES_FILE, IP_DENYLIST_FILE))
+    keys = [key for key in VT_API_KEYS if key]
+    summary = {'watchlist': watchlist, 'quota_day': day, 'quota_limit': VT_LIMITS['in_a_day'] * len(keys),
+               'api_keys': len(keys), **summary}
+    if as_json:
+        print(json.dumps(summary, default=lambda value: value.isoformat(), ensure_ascii=False, indent=2))
+        return
+    print(f"Список наблюдения: {'нет файла ' + IP_ADDRESSES_FILE if watchlist is None else watchlist} IP-адресов")
+    print(f"В БД: IP-адресов {summary['ips']}, имен хостов {summary['hosts']}, пар {summary['mappings']}")
+    print(f"Обойдено IP-адресов: {summary['crawled_ips']}, с полной историей {summary['backfilled_ips']}, "
+          f"последний обход {summary['last_crawl_at'] or '—'} (UTC)")
+    print(f"Отложено IP-адресов: {summary['pending_ips']}, незавершенных обходов {summary['unfinished_crawls']}, "
+          f"активных аренд {summary['active_leases']}")
+    print(f"Квота VirusTotal за {day}: {summary['quota_used']} из {summary['quota_limit']} "
+          f"({summary['api_keys']} ключей)")
+    print(f"Очередь Telegram: ожидают {summary['outbox_pending']}, не доставлено {summary['outbox_failed']}")
+    for export_state in summary['exports']:
+        print(f"Выгрузка {export_state['name']}: до {export_state['watermark']}, "
+              f"{export_state['rows']} строк в {export_state['exported_at']} (UTC)")
+
+async def lookup(domains, include_subdomains=False, as_json=False):
+    """
+    Выводит IP-адреса, в которые разрешались домены: TSV или JSON.
+    :param domains: Имена хостов или зоны
+    :param include_subdomains: Искать также все поддомены
+    :param as_json: Вывести JSON вместо TSV
+    """
+    db = make_db()
+    await db.init()
+    try:
+        found = await db.find_ip_by_domains(domains, include_subdomains=include_subdomains)
+    finally:
+        await db.close()
+    if as_json:
+        print(json.dumps(found, default=lambda value: value.isoformat(), ensure_ascii=False, indent=2))
+        return
+    for domain, matches in found.items():
+        for match in matches:
+            print('\t'.join((domain, match['ip_address'], match['host_name'],
+                             match['first_seen'].isoformat(), match['last_seen'].isoformat())))
+
+async def export(path, fmt=None, compression=None, networks=(), since=None, until=None, incremental=None,
+                 chunk_size=10000):
+    """
+    Выгружает пары IP-адрес — имя хоста в NDJSON, CSV или Parquet.
+    :param networks: Блоки ip_network для отбора IP-адресов
+    """
+    from data import export_mappings
+
+    db = make_db()
+    await db.init()
+    try:
+        await export_mappings(db, path, fmt=fmt, compression=compression, networks=networks, since=since,
+                              until=until, incremental=incremental, chunk_size=chunk_size)
+    finally:
+        await db.close()
 
-    if DEBUG:
-        await save_data_as_json(transform_ip_resolutions_, new_domains)
-    await DB.save_data(new_domains)
+def read_domains(args):
+    """
+    Домены из аргументов и файла --file ('-' — стандартный ввод), по одному в строке.
+    """
+    domains = list(args.domains)
+    if args.file:
+        file = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8')
+        with file:
+            domains.extend(line.strip() for line in file if line.strip() and not line.startswith('#'))
+    return domains
 
-    messages = generate_telegram_messages(new_domains)
-    async with TelegramBot(TELEGRAM_TOKEN, TELEGRAM_CHANNEL_ID) as bot:
-        await bot.add_messages_to_queue(messages)
+def parse_networks(entries):
+    """
+    Блоки ip_network из записей --ip: адресов, блоков CIDR и диапазонов.
+    :raises ValueError: если запись не является адресом, блоком или диапазоном
+    """
+    from data.watchlist import parse_entry
+    return [network for entry in entries for network in parse_entry(entry, hosts_only=False)]
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description='Мониторинг новых доменов на IP-адресах')
+    commands = parser.add_subparsers(dest='mode', metavar='{run,status,daemon,worker,lookup,export}')
+    commands.add_parser('run', help='однократный запуск (cron), по умолчанию')
+    status_parser = commands.add_parser('status', help='состояние списка наблюдения, БД, квоты и очереди')
+    status_parser.add_argument('--json', action='store_true', help='вывести JSON вместо текста')
+    commands.add_parser('daemon', help='постоянная работа')
+    worker_parser = commands.add_parser('worker', help='один из процессов, делящих список IP-адресов')
+    worker_parser.add_argument('--once', action='store_true', help='завершиться, когда свободных IP-адресов нет')
+    lookup_parser = commands.add_parser('lookup', help='IP-адреса, в которые разрешались домены')
+    lookup_parser.add_argument('domains', nargs='*', help='имена хостов или зоны')
+    lookup_parser.add_argument('--file', help="файл со списком доменов, '-' — стандартный ввод")
+    lookup_parser.add_argument('--subdomains', action='store_true', help='искать также все поддомены')
+    lookup_parser.add_argument('--json', action='store_true', help='вывести JSON вместо TSV')
+    export_parser = commands.add_parser('export', help='выгрузка пар IP-адрес — имя хоста')
+    export_parser.add_argument('path', help="файл (.ndjson, .csv, .parquet, можно .gz/.bz2/.xz) или '-'")
+    export_parser.add_argument('--format', choices=['ndjson', 'csv', 'parquet'], help='по умолчанию — по расширению')
+    export_parser.add_argument('--compression', help='gzip, bz2, xz; для parquet — snappy, zstd, gzip, none')
+    export_parser.add_argument('--ip', action='append', default=[], help='адрес, блок CIDR или диапазон; можно несколько')
+    export_parser.add_argument('--since', type=datetime.fromisoformat,
+                               help='first_seen не раньше (ISO 8601, без смещения — UTC)')
+    export_parser.add_argument('--until', type=datetime.fromisoformat,
+                               help='first_seen раньше (ISO 8601, без смещения — UTC)')
+    export_parser.add_argument('--incremental', metavar='NAME',
+                               help='только пары, записанные после прошлой выгрузки с этим именем')
+    export_parser.add_argument('--chunk-size', type=int, default=10000, help='строк в пачке')
+    args = parser.parse_args()
+    if args.mode == 'status':
+        asyncio.run(status(as_json=args.json))
+    elif args.mode == 'daemon':
+        asyncio.run(run_daemon())
+    elif args.mode == 'worker':
+        asyncio.run(run_worker(once=args.once))
+    elif args.mode == 'lookup':
+        domains = read_domains(args)
+        if not domains:
+            lookup_parser.error('не указаны домены')
+        asyncio.run(lookup(domains, include_subdomains=args.subdomains, as_json=args.json))
+    elif args.mode == 'export':
+        try:
+            networks = parse_networks(args.ip)
+        except ValueError as error:
+            export_parser.error(str(error))
+        asyncio.run(export(args.path, fmt=args.format, compression=args.compression, networks=networks,
+                           since=args.since, until=args.until, incremental=args.incremental,
+                           chunk_size=args.chunk_size))
+    else:
+        asyncio.run(main())
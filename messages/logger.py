@@ -25,7 +25,8 @@ logger.setLevel(logging.DEBUG)
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.DEBUG)
-file_handler = logging.FileHandler('data/app.log')
+# Файл открывается при первой записи: импорт модуля ничего не создает на диске
+file_handler = logging.FileHandler('data/app.log', delay=True)
 file_handler.setLevel(logging.INFO)
 
 formatter = ColorFormatter('%(asctime)s - %(levelname)s - %(message)s')
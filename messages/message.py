@@ -1,55 +1,75 @@
+import html
 from datetime import datetime
 
+# Лимит длины сообщения (в Telegram — 4096 единиц UTF-16 после экранирования)
+MESSAGE_LIMIT = 4000
+INFO_LINK = "https://www.virustotal.com/gui/home/url"
+LINK_DESCRIPTION = f"Детальная информация на: {INFO_LINK}"
 
-def generate_telegram_messages(new_domains):
+
+def telegram_length(text):
     """
-    Генерирует сообщения для Telegram из структуры данных new_domains.
+    Длина текста так, как ее считает Telegram: после HTML-экранирования
+    (TelegramBot отправляет html.quote(message)) в единицах UTF-16.
+    """
+    return len(html.escape(text, quote=False).encode('utf-16-le')) // 2
 
-    :param new_domains: Словарь с данными о доменах
-    :return: Список сообщений для отправки в Telegram
+
+def iter_telegram_messages(new_domains, limit=MESSAGE_LIMIT):
+    """
+    Лениво формирует сообщения для Telegram из структуры данных new_domains.
+    Длина части считается нарастающим итогом вместе с переводами строк
+    и ссылкой в конце, поэтому ни одна часть не превышает limit.
+
+    :param new_domains: Словарь IP-адресов и Resolutions (или списков словарей
+                        с 'host_name' и 'date')
+    :param limit: Максимальная длина сообщения
+    :return: Генератор сообщений
     """
-    messages = []
-    info_link = "https://www.virustotal.com/gui/home/url"
-    link_description = f"Детальная информация на: {info_link}"
+    link_length = telegram_length(LINK_DESCRIPTION)
 
     for ip_address, domains in new_domains.items():
         # Заголовок с выразительным значком для каждого IP-адреса
-        message_lines = [f"🔹 Новые домены для IP {ip_address}:"]
+        header = f"🔹 Новые домены для IP {ip_address}:"
+        lines = [header]
+        length = telegram_length(header)
 
         for domain_info in domains:
-            host_name = domain_info['host_name']
+            # Resolutions отдает пары (host_name, date)
+            if isinstance(domain_info, dict):
+                host_name, date = domain_info['host_name'], domain_info['date']
+            else:
+                host_name, date = domain_info
             # Преобразуем дату из UNIX timestamp в формат YYYY-MM-DD
-            date = datetime.utcfromtimestamp(domain_info['date']).strftime('%Y-%m-%d')
+            date = datetime.utcfromtimestamp(date).strftime('%Y-%m-%d')
             # Формируем строку с разделителями
-            message_line = f"{host_name} ➖ {date}"
-            message_lines.append(message_line)
+            line = f"{host_name} ➖ {date}"
+            line_length = telegram_length(line)
+
+            # +1 за перевод строки перед строкой и перед ссылкой
+            if length + 1 + line_length + 1 + link_length > limit:
+                # Добавляем ссылку в конец каждой части
+                lines.append(LINK_DESCRIPTION)
+                yield "\n".join(lines)
+                lines = [line]
+                length = line_length
+            else:
+                lines.append(line)
+                length += 1 + line_length
 
-        # Добавляем описание с ссылкой в конец сообщения
-        message_lines.append(link_description)
+        # Добавляем описание с ссылкой в конец последней части
+        lines.append(LINK_DESCRIPTION)
+        yield "\n".join(lines)
 
-        # Создаем сообщение для текущего IP-адреса
-        current_message = "\n".join(message_lines)
 
-        # Если сообщение слишком длинное, разбиваем его
-        if len(current_message) > 4000:
-            current_message_parts = []
-            part = []
-            for line in message_lines:
-                if sum(len(p) for p in part) + len(line) + 1 > 4000:  # +1 для новой строки
-                    # Добавляем ссылку в конец каждой части
-                    part.append(link_description)
-                    current_message_parts.append("\n".join(part))
-                    part = [line]
-                else:
-                    part.append(line)
-            if part:
-                part.append(link_description)  # Добавляем ссылку в последнюю часть
-                current_message_parts.append("\n".join(part))
-            messages.extend(current_message_parts)
-        else:
-            messages.append(current_message)
+def generate_telegram_messages(new_domains):
+    """
+    Генерирует сообщения для Telegram из структуры данных new_domains.
 
-    return messages
+    :param new_domains: Словарь с данными о доменах
+    :return: Список сообщений для отправки в Telegram
+    """
+    return list(iter_telegram_messages(new_domains))
 
 if __name__ == '__main__':
     # Пример использования
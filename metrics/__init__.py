@@ -0,0 +1,3 @@
+from .metrics import *
+from .server import *
+from .spans import *
\ No newline at end of file
@@ -0,0 +1,211 @@
+import json
+import time
+from functools import wraps
+
+from .spans import span
+
+# Границы гистограмм длительности, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Metric:
+    """
+    Базовая метрика с метками. Значения хранятся по кортежу значений меток.
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}")
+        key = tuple(str(value) for value in labelvalues)
+        if key not in self._values:
+            self._values[key] = self._new_value()
+        return _Child(self, key)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            '{}="{}"'.format(name, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for name, value in pairs
+        )
+        return '{' + ','.join(escaped) + '}'
+
+
+class _Child:
+    """
+    Метрика с зафиксированными значениями меток.
+    """
+    def __init__(self, metric, key):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount=1):
+        self.metric._inc(self.key, amount)
+
+    def set(self, value):
+        self.metric._set(self.key, value)
+
+    def observe(self, value):
+        self.metric._observe(self.key, value)
+
+    def time(self):
+        return _Timer(self.observe)
+
+
+class _Timer:
+    def __init__(self, callback):
+        self.callback = callback
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.callback(time.perf_counter() - self.started)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_value(self):
+        return 0
+
+    def _inc(self, key, amount):
+        self._values[key] += amount
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, (), value
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_value(self):
+        return 0
+
+    def _inc(self, key, amount):
+        self._values[key] += amount
+
+    def _set(self, key, value):
+        self._values[key] = value
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, key, (), value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_value(self):
+        return {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+    def _observe(self, key, value):
+        data = self._values[key]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                data['buckets'][index] += 1
+        data['sum'] += value
+        data['count'] += 1
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for key, data in self._values.items():
+            for bound, count in zip(self.buckets, data['buckets']):
+                yield self.name + '_bucket', key, (('le', repr(float(bound))),), count
+            yield self.name + '_bucket', key, (('le', '+Inf'),), data['count']
+            yield self.name + '_sum', key, (), data['sum']
+            yield self.name + '_count', key, (), data['count']
+
+
+class Registry:
+    """
+    Набор метрик процесса с выводом в текстовом формате Prometheus и в JSON.
+    """
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def render_prometheus(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            for name, key, extra, value in metric.samples():
+                lines.append(f'{name}{metric._format_labels(key, extra)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Текущие значения всех метрик: {имя: [{'labels': {...}, 'value': ...}]}.
+        """
+        return {
+            metric.name: [
+                {'labels': dict(zip(metric.labelnames, key)), 'value': value}
+                for key, value in metric._values.items()
+            ]
+            for metric in self.metrics
+        }
+
+    def write_snapshot(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(self.snapshot(), file, ensure_ascii=False, indent=2)
+
+
+REGISTRY = Registry()
+
+
+# Метрики VirusTotal
+VT_REQUESTS = Counter('vt_requests_total', 'Запросы к API VirusTotal', ['key', 'status'])
+VT_REQUEST_SECONDS = Histogram('vt_request_seconds', 'Длительность запроса к VirusTotal', ['key'])
+VT_PAGES_PER_IP = Histogram('vt_pages_per_ip', 'Страниц разрешений за обход IP-адреса',
+                            buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000))
+VT_QUOTA_REMAINING = Gauge('vt_quota_remaining', 'Остаток дневной квоты ключа', ['key'])
+
+# Метрики базы данных
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Длительность метода IPDomainDatabaseAsync', ['method'])
+DB_ROWS = Counter('db_rows_total', 'Строк обработано методом IPDomainDatabaseAsync', ['method'])
+
+# Метрики Telegram
+TG_QUEUE_DEPTH = Gauge('telegram_queue_depth', 'Сообщений в очереди чата', ['chat'])
+TG_SEND_SECONDS = Histogram('telegram_send_seconds', 'Длительность отправки сообщения', ['chat'])
+TG_RETRIES = Counter('telegram_retries_total', 'Повторные попытки отправки', ['chat', 'reason'])
+TG_MESSAGES = Counter('telegram_messages_total', 'Сообщения по результату отправки', ['chat', 'status'])
+
+
+def timed(histogram):
+    """
+    Декоратор асинхронного метода: записывает длительность в histogram
+    с меткой — именем метода и открывает интервал с тем же именем.
+    """
+    def decorator(method):
+        @wraps(method)
+        async def wrapper(*args, **kwargs):
+            with span(method.__name__), histogram.labels(method.__name__).time():
+                return await method(*args, **kwargs)
+        return wrapper
+    return decorator
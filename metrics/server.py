@@ -0,0 +1,36 @@
+import asyncio
+
+from messages import logger
+from .metrics import REGISTRY
+
+
+async def _handle(reader, writer, registry):
+    try:
+        request_line = await reader.readline()
+        # Заголовки запроса не нужны, но их нужно дочитать
+        while (await reader.readline()).strip():
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', registry.render_prometheus().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host='127.0.0.1', port=9464, registry=REGISTRY):
+    """
+    Запускает HTTP-эндпоинт /metrics в формате Prometheus.
+    :return: asyncio.Server; остановка — server.close()
+    """
+    server = await asyncio.start_server(lambda r, w: _handle(r, w, registry), host, port)
+    logger.info(f"Метрики доступны на http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,213 @@
+import asyncio
+import contextvars
+import cProfile
+import os
+import time
+from collections import Counter as _Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+from messages import logger
+
+# Путь текущего интервала: ('fetch', 'ip', 'page'). Задачи, созданные внутри
+# интервала, наследуют путь вместе с контекстом
+_current_path = contextvars.ContextVar('span_path', default=())
+
+
+class _SpanStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+
+class CProfileHook:
+    """
+    cProfile на время выполнения этапа. Профилируется весь поток, поэтому
+    в профиль попадает и код этапов, работающих в это время параллельно.
+    """
+    suffix = 'prof'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.active = 0
+
+    def enter(self, task):
+        self.active += 1
+        if self.active == 1:
+            self.profile.enable()
+
+    def exit(self, task):
+        self.active -= 1
+        if not self.active:
+            self.profile.disable()
+
+    async def close(self):
+        if self.active:
+            self.profile.disable()
+
+    def dump(self, path):
+        self.profile.dump_stats(path)
+
+
+class TaskSampler:
+    """
+    Сэмплер задач asyncio: раз в interval секунд записывает цепочку корутин
+    каждой задачи, находящейся внутри профилируемого этапа. Показывает, где
+    задачи ждут (ведро токенов, сеть, повтор), а не только время CPU.
+    Результат — свернутые стеки (формат flamegraph.pl и speedscope).
+    """
+    suffix = 'folded'
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.tasks = _Counter()
+        self.stacks = _Counter()
+        self._task = None
+
+    def enter(self, task):
+        if task is None:
+            return
+        self.tasks[task] += 1
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def exit(self, task):
+        if task is None:
+            return
+        self.tasks[task] -= 1
+        if self.tasks[task] <= 0:
+            del self.tasks[task]
+
+    @staticmethod
+    def _stack(task):
+        frames = []
+        coro = task.get_coro()
+        while coro is not None:
+            frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+            if frame is None:
+                break
+            code = frame.f_code
+            frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+        return ';'.join(frames)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for task in list(self.tasks):
+                if not task.done() and (stack := self._stack(task)):
+                    self.stacks[stack] += 1
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+PROFILERS = {'cprofile': CProfileHook, 'sampler': TaskSampler}
+
+
+class Tracer:
+    """
+    Интервалы времени по этапам запуска. Вложенные интервалы суммируются
+    по пути ('fetch/ip/page'), поэтому у параллельных задач их сумма может
+    превышать время этапа.
+    """
+    def __init__(self):
+        self.stats = {}
+        # Порядок первого входа, чтобы таблица шла в порядке этапов
+        self._order = {}
+        self.profile_stage = None
+        self.profiler = None
+        self.profile_dir = None
+
+    def configure_profiler(self, stage, mode='cprofile', directory='data/profiles'):
+        """
+        Включает профилирование одного этапа.
+        :param stage: Имя интервала, например 'fetch' или 'save'
+        :param mode: 'cprofile' или 'sampler'
+        :param directory: Каталог для файлов профиля
+        """
+        if mode not in PROFILERS:
+            raise ValueError(f"Неизвестный профилировщик {mode}, доступны: {', '.join(PROFILERS)}")
+        self.profile_stage = stage
+        self.profiler = PROFILERS[mode]()
+        self.profile_dir = directory
+
+    @contextmanager
+    def span(self, name):
+        """
+        Замеряет время блока. Можно использовать и вокруг await.
+        """
+        path = _current_path.get() + (name,)
+        token = _current_path.set(path)
+        self._order.setdefault(path, len(self._order))
+        profiled = self.profiler is not None and self.profile_stage in path
+        if profiled:
+            task = asyncio.current_task()
+            self.profiler.enter(task)
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            if profiled:
+                self.profiler.exit(task)
+            _current_path.reset(token)
+            stats = self.stats.get(path)
+            if stats is None:
+                self._order.setdefault(path, len(self._order))
+                stats = self.stats[path] = _SpanStats()
+            stats.add(duration)
+
+    async def finish(self):
+        """
+        Останавливает профилировщик и записывает профиль в profile_dir.
+        :return: Путь к файлу профиля или None
+        """
+        if self.profiler is None:
+            return None
+        await self.profiler.close()
+        os.makedirs(self.profile_dir, exist_ok=True)
+        timestamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        path = os.path.join(self.profile_dir, f"{self.profile_stage}-{timestamp}.{self.profiler.suffix}")
+        self.profiler.dump(path)
+        logger.info(f"Профиль этапа {self.profile_stage} сохранен в {path}")
+        return path
+
+    def format_table(self):
+        """
+        :return: Таблица интервалов: путь, количество, сумма, среднее и максимум
+        """
+        rows = [('stage', 'count', 'total, s', 'mean, ms', 'max, ms')]
+        for path in sorted(self.stats, key=lambda path: [self._order[path[:i]] for i in range(1, len(path) + 1)]):
+            stats = self.stats[path]
+            rows.append(('  ' * (len(path) - 1) + path[-1], str(stats.count), f"{stats.total:.3f}",
+                         f"{stats.total / stats.count * 1000:.1f}", f"{stats.max * 1000:.1f}"))
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return '\n'.join(
+            row[0].ljust(widths[0]) + ''.join(cell.rjust(width + 2) for cell, width in zip(row[1:], widths[1:]))
+            for row in rows
+        )
+
+    def reset(self):
+        self.stats.clear()
+        self._order.clear()
+
+
+TRACER = Tracer()
+span = TRACER.span
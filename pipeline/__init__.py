@@ -0,0 +1 @@
+from .pipeline import *
\ No newline at end of file
@@ -0,0 +1,123 @@
+import asyncio
+import inspect
+
+from data import transform_ip_resolutions, save_data_as_json
+from messages import iter_telegram_messages, logger
+from metrics import span
+
+# Признак конца потока в очередях между этапами
+_DONE = object()
+
+
+async def _stage(name, handler, inbox, outbox=None):
+    """
+    Этап конвейера: обрабатывает элементы inbox по одному и передает
+    непустые результаты в outbox. Ограниченный outbox задерживает этап,
+    пока следующий этап не освободит место.
+    Время обработки каждого элемента записывается в интервал name,
+    ожидание входной и выходной очереди в него не входит.
+    """
+    while (item := await inbox.get()) is not _DONE:
+        with span(name):
+            result = handler(item)
+            if inspect.isawaitable(result):
+                result = await result
+        if result is not None and outbox is not None:
+            await outbox.put(result)
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def run_pipeline(request, db, outbox, ip_address_data, queue_size=2, debug=False, backfill=False,
+                       on_saved=None, watermarks=None):
+    """
+    Обрабатывает IP-адреса потоково: fetch → transform → filter → render → save.
+    Каждый IP-адрес проходит все этапы сразу после получения его страниц.
+    Сообщения записываются в telegram_outbox в одной транзакции с новыми доменами
+    и отправляются OutboxSender.
+    :param request: Request
+    :param db: IPDomainDatabaseAsync
+    :param outbox: OutboxSender, открытый через async with
+    :param ip_address_data: Словарь с IP-адресами и датами последней записи или False
+    :param queue_size: Размер очередей между этапами
+    :param debug: Сохранить промежуточные данные в data/example_data
+    :param backfill: Обход истории новых IP-адресов: домены старше водяного знака
+                     сохраняются без уведомлений
+    :param on_saved: Корутинная функция, вызывается с IP-адресом после записи его результатов
+    :param watermarks: При backfill — словарь {IP: последняя известная дата или False}; о новых
+                       доменах не старше этой даты уведомления отправляются, как при обычном обходе
+    :return: Словарь с количеством обработанных IP, новых доменов, сообщений
+             и числом новых доменов по каждому IP ('yield')
+    """
+    fetched, transformed, filtered, rendered = (asyncio.Queue(queue_size) for _ in range(4))
+    stats = {'ip_addresses': 0, 'new_domains': 0, 'messages': 0, 'yield': {}}
+    debug_data = ({}, {})
+
+    async def fetch():
+        with span('fetch'):
+            await request.stream_domains_by_ip_addresses(ip_address_data, fetched, backfill=backfill)
+        await fetched.put(_DONE)
+
+    def transform(item):
+        ip_address, data = item
+        stats['ip_addresses'] += 1
+        return transform_ip_resolutions({ip_address: data})
+
+    async def filter_new(transformed_ip):
+        new_domains = await db.filter_new_domains(transformed_ip)
+        if debug:
+            debug_data[0].update(transformed_ip)
+            debug_data[1].update(new_domains)
+        return transformed_ip, new_domains
+
+    def render(item):
+        transformed_ip, new_domains = item
+        alerts = new_domains
+        if backfill:
+            # Без уведомлений сохраняется только история старше водяного знака: новые
+            # разрешения обычный обход уже не получит, они попадут в ip_hosts сейчас
+            alerts = {}
+            for ip_address, entries in new_domains.items():
+                watermark = (watermarks or {}).get(ip_address)
+                if watermark:
+                    recent = entries.take(index for index, date in enumerate(entries.dates) if date >= watermark)
+                    if recent:
+                        alerts[ip_address] = recent
+        messages = [(chat_id, message)
+                    for message in iter_telegram_messages(alerts)
+                    for chat_id in outbox.chat_ids]
+        return transformed_ip, new_domains, messages
+
+    async def save(item):
+        transformed_ip, new_domains, messages = item
+        # Сохраняются все полученные пары: новые добавляются, у известных обновляется
+        # last_seen; уведомления — только о новых доменах (new_domains)
+        await db.save_data(transformed_ip, update_last_seen=True, outbox=messages)
+        if messages:
+            outbox.notify()
+        # Страницы удаляются только после записи результатов в БД
+        await db.clear_checkpoints([request.checkpoint_key(ip_address) for ip_address in transformed_ip])
+        stats['new_domains'] += sum(len(domains) for domains in new_domains.values())
+        stats['messages'] += len(messages)
+        for ip_address, resolutions in transformed_ip.items():
+            found = len(new_domains.get(ip_address, ()))
+            stats['yield'][ip_address] = found
+            await db.update_crawl_state(ip_address, requests=request.ip_requests[ip_address],
+                                        new_domains=found, pages=request.ip_pages[ip_address],
+                                        newest_seen_date=resolutions.max_date() if resolutions else None,
+                                        backfilled=ip_address in request.backfilled)
+            if on_saved is not None:
+                await on_saved(ip_address)
+
+    async with asyncio.TaskGroup() as tg:
+        tg.create_task(fetch())
+        tg.create_task(_stage('transform', transform, fetched, transformed))
+        tg.create_task(_stage('filter', filter_new, transformed, filtered))
+        tg.create_task(_stage('render', render, filtered, rendered))
+        tg.create_task(_stage('save', save, rendered))
+
+    if debug:
+        await save_data_as_json(*debug_data)
+    logger.info(f"Обработано IP: {stats['ip_addresses']}, новых доменов: {stats['new_domains']}, "
+                f"сообщений: {stats['messages']}")
+    return stats
@@ -0,0 +1 @@
+from .planner import *
\ No newline at end of file
@@ -0,0 +1,103 @@
+import heapq
+import math
+from datetime import datetime, timedelta
+
+from data import chunks
+from messages import logger
+
+
+class Planner:
+    """
+    Планировщик опроса: отдает ограниченный бюджет запросов IP-адресам,
+    от которых вероятнее всего ждать новых доменов, и гарантирует, что
+    каждый IP-адрес опрашивается не реже чем раз в max_interval_hours.
+    """
+    def __init__(self, db, max_interval_hours=168, window_days=30):
+        """
+        :param db: IPDomainDatabaseAsync
+        :param max_interval_hours: Максимальный интервал между опросами одного IP
+        :param window_days: Окно истории для оценки частоты появления доменов
+        """
+        self.db = db
+        self.max_interval = timedelta(hours=max_interval_hours)
+        self.window = timedelta(days=window_days)
+        self.expected = {}
+
+    def _estimate(self, stats, now):
+        """
+        Ожидаемое число новых доменов и стоимость опроса IP-адреса в запросах.
+        """
+        window_hours = self.window.total_seconds() / 3600
+        # +1 к числу доменов, чтобы IP без недавней истории не получали нулевой шанс
+        rate = (stats['recent'] + 1) / window_hours
+        if stats['last_crawl_at'] is None:
+            hours_since_crawl = window_hours
+        else:
+            hours_since_crawl = (now - stats['last_crawl_at']).total_seconds() / 3600
+        expected = rate * min(hours_since_crawl, window_hours)
+        cost = max(stats['requests_spent'] / stats['crawls'], 1) if stats['crawls'] else 1
+        return expected, cost
+
+    async def plan(self, ip_addresses, budget=None, priority=(), chunk_size=900):
+        """
+        Выбирает и упорядочивает IP-адреса для опроса.
+        :param ip_addresses: Итерируемое отслеживаемых IP-адресов, например Watchlist;
+                             читается по частям
+        :param budget: Бюджет запросов на запуск или None (опросить все)
+        :param priority: IP-адреса, отложенные прошлым запуском
+        :param chunk_size: Количество IP-адресов в одном запросе истории
+        :return: Список IP-адресов в порядке опроса
+        """
+        now = datetime.utcnow()
+        priority = set(priority)
+        # Опрос IP-адреса стоит не меньше одного запроса, поэтому в каждой группе
+        # достаточно хранить не больше budget лучших кандидатов
+        limit = None if budget is None else max(math.ceil(budget), 1)
+        due_key = lambda item: item[3]
+        ranked_key = lambda item: -item[1] / item[2]
+        due, ranked = [], []
+        total = overdue_total = 0
+        for chunk in chunks(ip_addresses, chunk_size):
+            stats = await self.db.get_ip_stats(chunk, since=now - self.window)
+            total += len(stats)
+            for ip_address, ip_stats in stats.items():
+                expected, cost = self._estimate(ip_stats, now)
+                last_crawl_at = ip_stats['last_crawl_at']
+                overdue = (ip_address in priority or last_crawl_at is None
+                           or now - last_crawl_at >= self.max_interval)
+                item = (ip_address, expected, cost, last_crawl_at or datetime.min)
+                (due if overdue else ranked).append(item)
+                overdue_total += overdue
+            if limit is not None:
+                if len(due) > 2 * limit:
+                    due = heapq.nsmallest(limit, due, key=due_key)
+                if len(ranked) > 2 * limit:
+                    ranked = heapq.nsmallest(limit, ranked, key=ranked_key)
+        # Просроченные — от самого давнего опроса, остальные — по доходности запроса
+        due.sort(key=due_key)
+        ranked.sort(key=ranked_key)
+
+        selected, spent = [], 0
+        for ip_address, expected, cost, _ in due + ranked:
+            if budget is not None and spent + cost > budget and selected:
+                continue
+            selected.append(ip_address)
+            self.expected[ip_address] = expected
+            spent += cost
+        logger.info(f"План опроса: {len(selected)} из {total} IP "
+                    f"(просрочено {overdue_total}), оценка запросов {math.ceil(spent)}")
+        return selected
+
+    def report(self, new_domains, requests):
+        """
+        Сравнивает ожидаемую и фактическую доходность опроса.
+        :param new_domains: Словарь {ip: число новых доменов}
+        :param requests: Словарь {ip: число запросов к API}
+        """
+        expected = sum(self.expected.get(ip_address, 0) for ip_address in new_domains)
+        actual = sum(new_domains.values())
+        spent = sum(requests.get(ip_address, 0) for ip_address in new_domains)
+        per_call = actual / spent if spent else 0
+        logger.info(f"Доходность: ожидалось {expected:.1f}, найдено {actual} новых доменов "
+                    f"за {spent} запросов ({per_call:.2f} на запрос)")
+        self.expected.clear()
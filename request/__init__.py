@@ -1 +1,3 @@
-from .request_ import *
\ No newline at end of file
+from .request_ import *
+from .rate_limiter import *
+from .key_pool import *
\ No newline at end of file
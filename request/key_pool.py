@@ -0,0 +1,192 @@
+import hashlib
+
+import vt
+
+from messages import logger
+from .rate_limiter import RateLimiter, DailyQuotaExceeded, RunBudgetExceeded, current_quota_day
+
+# Ошибки, после которых ключ больше не получает запросов до конца запуска
+AUTH_ERRORS = {'WrongCredentialsError', 'AuthenticationRequiredError',
+               'UserNotActiveError', 'ForbiddenError'}
+# Ошибки, после которых ключ не получает запросов до конца суток
+QUOTA_ERRORS = {'QuotaExceededError'}
+# Ошибки запроса, повтор которых не поможет: IP-адрес пропускается сразу
+PERMANENT_ERRORS = {'NotFoundError', 'BadRequestError', 'InvalidArgumentError',
+                    'AlreadyExistsError', 'UnselectiveContentQueryError',
+                    'UnsupportedContentQueryError', 'ClientError'}
+
+
+def classify_error(error):
+    """
+    Класс ошибки запроса к API по коду vt.APIError.
+    :return: 'auth', 'quota', 'permanent' или 'transient' (сеть, 5xx,
+             TooManyRequestsError, TransientError и неизвестные коды)
+    """
+    code = getattr(error, 'code', None)
+    if code in AUTH_ERRORS:
+        return 'auth'
+    if code in QUOTA_ERRORS:
+        return 'quota'
+    if code in PERMANENT_ERRORS:
+        return 'permanent'
+    return 'transient'
+
+
+class APIKey:
+    """
+    Ключ API VirusTotal со своим клиентом, ограничителем и статистикой.
+    """
+    def __init__(self, api_key, limits, store=None, host=None):
+        self.api_key = api_key
+        self.host = host
+        # В БД и логах хранится только отпечаток ключа
+        self.key_id = hashlib.sha256(api_key.encode()).hexdigest()[:12]
+        self.limiter = RateLimiter(limits['per_minute'], limits['in_a_day'],
+                                   store=store, key_id=self.key_id)
+        self.client = None
+        self.retired = None
+        self.exhausted_day = None
+        self.stats = {'requests': 0, 'errors': 0}
+
+    @property
+    def active(self):
+        return not self.retired and self.exhausted_day != current_quota_day()
+
+    def open(self):
+        if self.client is None:
+            self.client = vt.Client(self.api_key, host=self.host)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close_async()
+            self.client = None
+
+
+class KeyPool:
+    """
+    Пул ключей API. Каждый запрос получает ключ, у которого раньше всех
+    освободится токен и остался дневной лимит.
+    """
+    def __init__(self, api_keys, limits, store=None, host=None):
+        """
+        :param api_keys: Ключ API или список ключей
+        :param limits: Словарь с лимитами 'per_minute' и 'in_a_day' на один ключ
+        :param store: Хранилище дневной квоты
+        :param host: Адрес API VirusTotal (по умолчанию https://www.virustotal.com)
+        """
+        if isinstance(api_keys, str):
+            api_keys = [api_keys]
+        self.keys = [APIKey(api_key, limits, store=store, host=host)
+                     for api_key in dict.fromkeys(api_keys) if api_key]
+        if not self.keys:
+            raise ValueError("Не указан ни один ключ API VirusTotal")
+        # Бюджет запросов на цикл (None — без ограничения, кроме дневной квоты)
+        self.budget = None
+        self.spent = 0
+        self.stopped = False
+        self._users = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def open(self):
+        for key in self.keys:
+            key.open()
+
+    async def close(self):
+        for key in self.keys:
+            await key.close()
+
+    async def __aenter__(self):
+        # Вложенные async with не закрывают клиентов: в режиме демона
+        # пул открыт на все время работы
+        if not self._users:
+            self.open()
+        self._users += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._users -= 1
+        if not self._users:
+            await self.close()
+
+    def set_budget(self, budget):
+        """
+        Задает бюджет запросов на следующий цикл.
+        После stop() новые запросы остаются запрещены.
+        :param budget: Число запросов или None
+        """
+        self.spent = 0
+        self.budget = 0 if self.stopped else budget
+
+    def stop(self):
+        """
+        Запрещает новые запросы: уже начатые завершаются, остальные IP откладываются.
+        """
+        self.stopped = True
+        self.budget = self.spent
+
+    async def remaining(self):
+        """
+        Остаток дневной квоты по всем действующим ключам.
+        """
+        return sum([await key.limiter.quota.remaining() for key in self.keys if key.active])
+
+    async def acquire(self):
+        """
+        Выбирает ключ с доступным бюджетом и ожидает для него токен.
+        :return: APIKey, от имени которого можно выполнить один запрос
+        :raises DailyQuotaExceeded: если у всех ключей исчерпан лимит
+        """
+        while True:
+            if self.budget is not None and self.spent >= self.budget:
+                raise RunBudgetExceeded(f"Бюджет цикла {self.budget} запросов исчерпан")
+            keys = [key for key in self.keys if key.active]
+            if not keys:
+                raise DailyQuotaExceeded("Все ключи API исчерпали дневной лимит или выведены из работы")
+            key = min(keys, key=lambda k: k.limiter.bucket.eta())
+            self.spent += 1
+            try:
+                await key.limiter.acquire()
+            except DailyQuotaExceeded:
+                self.spent -= 1
+                key.exhausted_day = current_quota_day()
+                continue
+            if not key.active:
+                # Пока задача ждала токен, ключ вывели из работы по ответу API другой задачи:
+                # запрос с ним заранее обречен, поэтому выбирается другой ключ
+                self.spent -= 1
+                continue
+            key.stats['requests'] += 1
+            return key
+
+    async def report_error(self, key, error):
+        """
+        Учитывает ошибку запроса и выводит ключ из работы при ошибках квоты или доступа.
+        :return: True, если ключ выведен из работы и запрос можно повторить другим ключом
+        """
+        key.stats['errors'] += 1
+        kind = classify_error(error)
+        if kind == 'auth':
+            if not key.retired:
+                logger.error(f"Ключ {key.key_id} выведен из работы: {error.code}")
+            key.retired = error.code
+            return True
+        if kind == 'quota':
+            await key.limiter.quota.exhaust()
+            if key.active:
+                logger.warning(f"Ключ {key.key_id} исчерпал дневной лимит по ответу API")
+            key.exhausted_day = current_quota_day()
+            return True
+        return False
+
+    def log_stats(self):
+        """
+        Выводит статистику использования ключей за запуск.
+        """
+        for key in self.keys:
+            quota = key.limiter.quota
+            status = key.retired or ('active' if key.active else 'exhausted')
+            logger.info(f"Ключ {key.key_id}: запросов {key.stats['requests']}, "
+                        f"ошибок {key.stats['errors']}, "
+                        f"за сутки {quota.used}/{quota.limit}, статус {status}")
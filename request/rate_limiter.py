@@ -0,0 +1,125 @@
+import asyncio
+import time
+from datetime import datetime, timezone
+
+
+class DailyQuotaExceeded(Exception):
+    """Дневной лимит запросов к API исчерпан."""
+
+
+class RunBudgetExceeded(DailyQuotaExceeded):
+    """Бюджет запросов текущего цикла исчерпан."""
+
+
+def current_quota_day():
+    """
+    Возвращает текущие сутки квоты VirusTotal (сброс в 00:00 UTC).
+    :return: Дата в формате YYYY-MM-DD
+    """
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d')
+
+
+class TokenBucket:
+    """
+    Ведро токенов: выдает не больше rate_per_minute разрешений в минуту.
+    При capacity=1 запросы идут строго через равные интервалы без всплесков.
+    """
+    def __init__(self, rate_per_minute, capacity=1):
+        self.rate = rate_per_minute / 60
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.waiters = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def eta(self):
+        """
+        Оценка времени ожидания токена с учетом уже стоящих в очереди.
+        :return: Секунды до выдачи токена новому запросу
+        """
+        self._refill()
+        return max(1 - self.tokens, 0) / self.rate + self.waiters / self.rate
+
+    async def acquire(self):
+        """
+        Ожидает свободный токен. Ожидающие обслуживаются в порядке очереди.
+        """
+        self.waiters += 1
+        try:
+            async with self._lock:
+                self._refill()
+                if self.tokens < 1:
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+                    self._refill()
+                self.tokens -= 1
+        finally:
+            self.waiters -= 1
+
+
+class DailyQuota:
+    """
+    Учет дневной квоты запросов. Счетчик хранится в store (SQLite),
+    поэтому перезапуск скрипта по cron не обнуляет израсходованные запросы.
+    """
+    def __init__(self, limit, store=None, key_id='default'):
+        self.limit = limit
+        self.store = store
+        self.key_id = key_id
+        self.day = None
+        self.used = 0
+        self._lock = asyncio.Lock()
+
+    async def _sync_day(self):
+        day = current_quota_day()
+        if day != self.day:
+            self.day = day
+            self.used = await self.store.get_quota_usage(self.key_id, day) if self.store else 0
+
+    async def remaining(self):
+        async with self._lock:
+            await self._sync_day()
+            return max(self.limit - self.used, 0)
+
+    async def exhaust(self):
+        """
+        Помечает квоту исчерпанной до конца суток (например, по ответу API).
+        Остаток записывается в store, чтобы следующие запуски не тратили
+        запрос на уже исчерпанный ключ.
+        """
+        async with self._lock:
+            await self._sync_day()
+            if self.used < self.limit:
+                if self.store:
+                    await self.store.add_quota_usage(self.key_id, self.day, self.limit - self.used)
+                self.used = self.limit
+
+    async def consume(self):
+        """
+        Резервирует один запрос из дневной квоты.
+        :raises DailyQuotaExceeded: если квота на сегодня исчерпана
+        """
+        async with self._lock:
+            await self._sync_day()
+            if self.used >= self.limit:
+                raise DailyQuotaExceeded(f"Дневной лимит {self.limit} запросов исчерпан ({self.key_id})")
+            self.used += 1
+            if self.store:
+                await self.store.add_quota_usage(self.key_id, self.day)
+
+
+class RateLimiter:
+    """
+    Общий ограничитель для всех запросов к API: дневная квота + ведро токенов.
+    """
+    def __init__(self, per_minute, in_a_day, store=None, key_id='default'):
+        self.bucket = TokenBucket(per_minute)
+        self.quota = DailyQuota(in_a_day, store=store, key_id=key_id)
+
+    async def acquire(self):
+        await self.quota.consume()
+        await self.bucket.acquire()
@@ -1,29 +1,66 @@
 import asyncio
+import random
+from collections import Counter
 from datetime import datetime
 
 import vt
 
+from data.resolutions import Resolutions
 from messages import logger
+from metrics import VT_REQUESTS, VT_REQUEST_SECONDS, VT_PAGES_PER_IP, VT_QUOTA_REMAINING, span
+from .rate_limiter import DailyQuotaExceeded
+from .key_pool import KeyPool, classify_error
 
 def get_max_and_min_dates(data):
-    first_date_in_data = min(
-        int(item['attributes']['date']) for item in data
-    )
-    last_date_in_data = max(
-        int(item['attributes']['date']) for item in data
-    )
+    first_date_in_data = data.min_date()
+    last_date_in_data = data.max_date()
     min_date = datetime.utcfromtimestamp(first_date_in_data).strftime('%Y-%m-%d %H:%M:%S')
     max_date = datetime.utcfromtimestamp(last_date_in_data).strftime('%Y-%m-%d %H:%M:%S')
     return min_date, max_date, last_date_in_data
 
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """
+    Экспоненциальная задержка перед повтором со случайным разбросом, чтобы
+    задачи, получившие ошибку одновременно, не повторяли запрос одновременно.
+    :param attempt: Номер неудачной попытки, начиная с 1
+    :return: Случайное время от 0 до min(cap, base * 2^attempt) секунд
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
 class Request:
-    def __init__(self, api_key: str):
-        self.API_KEY = api_key
+    def __init__(self, api_keys, quota_store=None, checkpoint_store=None, limits=None, host=None,
+                 max_attempts=3, backoff_base=1.0, backoff_cap=60.0):
+        """
+        :param api_keys: Ключ API VirusTotal или список ключей
+        :param quota_store: Хранилище дневной квоты (IPDomainDatabaseAsync) или None
+        :param checkpoint_store: Хранилище полученных страниц (IPDomainDatabaseAsync) или None
+        :param limits: Лимиты ключа {'per_minute', 'in_a_day'} вместо лимитов бесплатного ключа
+        :param host: Адрес API VirusTotal (например, локальный сервер бенчмарка)
+        :param max_attempts: Попыток запроса страницы при временных ошибках
+        :param backoff_base: Начальная задержка повтора, секунды
+        :param backoff_cap: Наибольшая задержка повтора, секунды
+        """
+        self.checkpoint_store = checkpoint_store
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        # Исходы запросов к API за запуск: 'useful' или класс ошибки
+        self.call_outcomes = Counter()
         self.ip_addresses = dict()
-        self.responses = dict()
-        self.limits = {'per_minute': 4, 'in_a_day': 500}
-        self.sleep_time = 60 / self.limits['per_minute']
-        self.requests_made_today = 0
+        self.deferred = []
+        # Количество запросов к API по каждому IP-адресу за текущий запуск
+        self.ip_requests = Counter()
+        # Количество полученных страниц и IP-адреса, обход которых дошел до конца истории
+        self.ip_pages = Counter()
+        self.backfilled = set()
+        # Обход всей истории без водяного знака, страницы сохраняются отдельно
+        self.backfill = False
+        self.limits = {'per_minute': 4, 'in_a_day': 500, **(limits or {})}
+        self.pool = KeyPool(api_keys, self.limits, store=quota_store, host=host)
+
+    @property
+    def requests_made_today(self):
+        return sum(key.limiter.quota.used for key in self.pool.keys)
 
     def update_ip_addresses(self, ip_address_data):
         """
@@ -36,69 +73,194 @@ class Request:
             else:
                 self.ip_addresses[ip_address] = last_check_time
 
-    async def _get_ip_resolutions(self, client, ip_address, limit=40, cursor=None):
+    def checkpoint_key(self, ip_address):
+        """
+        Ключ сохраненных страниц: у обхода истории он свой, чтобы обычный
+        обход не продолжил чужой курсор.
+        """
+        return f'backfill:{ip_address}' if self.backfill else ip_address
+
+    async def _get_ip_resolutions(self, ip_address, limit=40, cursor=None):
         params = {'limit': limit}
         if cursor:
             params['cursor'] = cursor
-        file = await client.get_json_async(
-            path=f'/ip_addresses/{ip_address}/resolutions',
-            params=params
-        )
-        self.requests_made_today += 1
-        return file
+        while True:
+            with span('rate_limit'):
+                key = await self.pool.acquire()
+            self.ip_requests[ip_address] += 1
+            quota = key.limiter.quota
+            VT_QUOTA_REMAINING.labels(key.key_id).set(max(quota.limit - quota.used, 0))
+            try:
+                with span('vt_request'), VT_REQUEST_SECONDS.labels(key.key_id).time():
+                    response = await key.client.get_json_async(
+                        path=f'/ip_addresses/{ip_address}/resolutions',
+                        params=params
+                    )
+                VT_REQUESTS.labels(key.key_id, 'ok').inc()
+                self.call_outcomes['useful'] += 1
+                return response
+            except vt.APIError as e:
+                VT_REQUESTS.labels(key.key_id, e.code).inc()
+                self.call_outcomes[classify_error(e)] += 1
+                # Ключ с ошибкой квоты или доступа выводится из работы для всех задач,
+                # запрос повторяется с другим ключом
+                if not await self.pool.report_error(key, e):
+                    raise
+            except Exception:
+                VT_REQUESTS.labels(key.key_id, 'error').inc()
+                self.call_outcomes['transient'] += 1
+                raise
+
+    def log_call_summary(self):
+        """
+        Выводит число полезных запросов и запросов, потраченных на ошибки.
+        """
+        useful = self.call_outcomes['useful']
+        wasted = {kind: count for kind, count in self.call_outcomes.items() if kind != 'useful'}
+        total = useful + sum(wasted.values())
+        if not total:
+            return
+        details = ', '.join(f"{kind} {count}" for kind, count in sorted(wasted.items()))
+        logger.info(f"Запросы к VirusTotal: полезных {useful}, впустую {total - useful}"
+                    f"{f' ({details})' if details else ''}, потери {(total - useful) / total:.1%}")
 
     async def fetch_all_resolutions(self):
         """
         Запрашивает разрешения для всех IP-адресов.
-        :return: Словарь с данными для каждого IP-адреса
-        """
-        semaphore = asyncio.Semaphore(self.limits['per_minute'])
-        async with vt.Client(self.API_KEY) as client:
-            tasks = [
-                self._fetch_ip_data(client, ip_address, semaphore)
-                for ip_address in self.ip_addresses
-            ]
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-        for result in results:
-            if isinstance(result, tuple):
-                ip_address, data = result
-                self.responses[ip_address] = data
-        return self.responses
-
-    async def _fetch_ip_data(self, client, ip_address, semaphore):
-        error_counter = 3
-        async with (semaphore):
+        IP-адреса, не обработанные из-за дневного лимита, попадают в self.deferred.
+        Результат не хранится в объекте, чтобы данные освобождались вместе с ним.
+        :return: Словарь с Resolutions для каждого IP-адреса
+        """
+        results = asyncio.Queue()
+        await self.stream_resolutions(results)
+        responses = {}
+        while not results.empty():
+            ip_address, data = results.get_nowait()
+            responses[ip_address] = data
+        return responses
+
+    async def stream_resolutions(self, queue):
+        """
+        Запрашивает разрешения для всех IP-адресов и кладет (ip_address, data)
+        в очередь сразу после завершения обхода каждого адреса.
+        Если очередь ограничена, обработчики ждут свободного места и не берут
+        новые адреса, поэтому в памяти находятся данные лишь нескольких IP.
+        :param queue: asyncio.Queue для результатов
+        """
+        self.deferred = []
+        ip_queue = asyncio.Queue()
+        for ip_address in self.ip_addresses:
+            ip_queue.put_nowait(ip_address)
+
+        async def worker():
+            while not ip_queue.empty():
+                ip_address = ip_queue.get_nowait()
+                try:
+                    with span('ip'):
+                        result = await self._fetch_ip_data(ip_address)
+                except Exception as e:
+                    logger.error(f"Ошибка при обработке IP {ip_address}: {e}")
+                    continue
+                if result:
+                    await queue.put(result)
+
+        self.call_outcomes.clear()
+        # Обработчиков больше, чем IP-адресов, не нужно: лишние сразу завершатся,
+        # но при большом per_minute заняли бы память
+        concurrency = min(self.limits['per_minute'] * len(self.pool), ip_queue.qsize())
+        async with self.pool:
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        self.pool.log_stats()
+        self.log_call_summary()
+
+    async def _fetch_ip_data(self, ip_address):
+        attempt = 0
+        pages = 0
+        try:
             last_check_time = self.ip_addresses[ip_address]
             cursor = None
-            all_data = []
+            all_data = Resolutions()
+            if self.checkpoint_store:
+                all_data, cursor, complete = await self.checkpoint_store.load_checkpoint(
+                    self.checkpoint_key(ip_address))
+                if complete:
+                    return ip_address, all_data
+                if all_data:
+                    logger.info(f"{ip_address} продолжение обхода с сохраненной страницы, записей: {len(all_data)}")
             while True:
                 try:
-                    response = await self._get_ip_resolutions(client, ip_address, cursor=cursor)
-                    all_data.extend(response['data'])
-                    (min_date_in_data,
-                     max_date_in_data,
-                     max_date_in_data_iso) = get_max_and_min_dates(response['data'])
-                    if 'next' in response['links']:
-                        cursor = response['meta']['cursor']
-                        if last_check_time:
-                            if max_date_in_data_iso < last_check_time:
-                                break
-                    else:
+                    with span('page'):
+                        response = await self._get_ip_resolutions(ip_address, cursor=cursor)
+                    # Из ответа сохраняются только имя хоста и дата
+                    page = Resolutions()
+                    for item in response['data']:
+                        attributes = item['attributes']
+                        page.append(attributes['host_name'], attributes['date'])
+                    pages += 1
+                    cursor = response['meta']['cursor'] if 'next' in response['links'] else None
+                    # Страниц после последней нет: получена вся история IP-адреса
+                    reached_end = cursor is None
+                    if page:
+                        (min_date_in_data,
+                         max_date_in_data,
+                         max_date_in_data_iso) = get_max_and_min_dates(page)
+                        logger.info(f"{ip_address} "
+                                    f"min_date:{min_date_in_data}, max_date:{max_date_in_data} "
+                                    f"response len:{len(page)}")
+                        # Разрешения идут от новых к старым: записи старше водяного знака
+                        # отбрасываются, следующие страницы целиком старше него
+                        if last_check_time and page.min_date() < last_check_time:
+                            page = page.take(index for index, date in enumerate(page.dates)
+                                             if date >= last_check_time)
+                            cursor = None
+                            reached_end = False
+                    all_data.extend(page)
+                    if self.checkpoint_store:
+                        await self.checkpoint_store.save_checkpoint(self.checkpoint_key(ip_address), page, cursor)
+                    if not cursor:
+                        if reached_end:
+                            self.backfilled.add(ip_address)
                         break
+                except DailyQuotaExceeded as e:
+                    # Неполные данные не возвращаем: иначе последняя дата в БД
+                    # сдвинется и пропущенные страницы не будут запрошены
+                    logger.warning(f"{e}. IP {ip_address} перенесен на следующий запуск")
+                    self.deferred.append(ip_address)
+                    return None
                 except Exception as e:
-                    error_counter -= 1
-                    logger.error(f"Ошибка при выполнении запроса для IP {ip_address}: {e}")
-                    if not error_counter:
+                    if classify_error(e) == 'permanent':
+                        if cursor is None:
+                            # Повтор того же запроса даст ту же ошибку (например, неверный IP-адрес)
+                            logger.warning(f"IP {ip_address} пропущен: {e}")
+                            return ip_address, all_data
+                        # Обход прерван посреди истории: неполные данные не возвращаем,
+                        # как и при исчерпании квоты
+                        logger.warning(f"IP {ip_address}: обход прерван на странице с курсором: {e}")
+                        if self.checkpoint_store:
+                            if pages:
+                                # Полученные страницы сохранены, обход продолжится со следующим запуском
+                                self.deferred.append(ip_address)
+                            else:
+                                # Ошибка на первом запросе после сохраненной страницы: курсор
+                                # недействителен, следующий обход начнется сначала
+                                await self.checkpoint_store.clear_checkpoints([self.checkpoint_key(ip_address)])
+                        return None
+                    attempt += 1
+                    logger.error(f"Ошибка при выполнении запроса для IP {ip_address} "
+                                 f"(попытка {attempt} из {self.max_attempts}): {e}")
+                    if attempt >= self.max_attempts:
+                        if self.checkpoint_store:
+                            # Полученные страницы сохранены, обход продолжится со следующим запуском
+                            self.deferred.append(ip_address)
+                            return None
                         return ip_address, all_data
-                else:
-                    logger.info(f"{ip_address} "
-                                f"min_date:{min_date_in_data}, max_date:{max_date_in_data} "
-                                f"response len:{len(response['data'])}")
-                finally:
-                    await asyncio.sleep(self.sleep_time)
+                    with span('backoff'):
+                        await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
 
             return ip_address, all_data
+        finally:
+            self.ip_pages[ip_address] += pages
+            VT_PAGES_PER_IP.observe(pages)
 
     async def fetch_domains_by_ip_addresses(self, ip_address_data):
         """
@@ -110,14 +272,28 @@ class Request:
         responses = await self.fetch_all_resolutions()
         return responses
 
+    async def stream_domains_by_ip_addresses(self, ip_address_data, queue, backfill=False):
+        """
+        Как fetch_domains_by_ip_addresses, но передает данные каждого IP-адреса в очередь.
+        :param ip_address_data: Словарь с IP-адресами и датами последней записи или False
+        :param queue: asyncio.Queue для кортежей (ip_address, data)
+        :param backfill: Обход истории: страницы сохраняются под отдельным ключом
+        """
+        self.ip_addresses = dict()
+        self.ip_pages.clear()
+        self.backfilled.clear()
+        self.backfill = backfill
+        self.update_ip_addresses(ip_address_data)
+        await self.stream_resolutions(queue)
+
 # Пример использования
 async def main():
     from dotenv import load_dotenv
     import os
     load_dotenv()
 
-    VT_API_KEY = os.getenv('VT_API_KEY')
-    request = Request(VT_API_KEY)
+    VT_API_KEYS = os.getenv('VT_API_KEYS', os.getenv('VT_API_KEY', '')).split(',')
+    request = Request(VT_API_KEYS)
 
     # Пример данных для ввода
     ip_address_data = {
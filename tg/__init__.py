@@ -1 +1,2 @@
-from .tg import *
\ No newline at end of file
+from .tg import *
+from .outbox import *
\ No newline at end of file
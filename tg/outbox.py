@@ -0,0 +1,102 @@
+import asyncio
+import os
+import socket
+
+from messages import logger
+
+
+class OutboxSender:
+    """
+    Отправляет сообщения из таблицы telegram_outbox через TelegramBot.
+    Сообщения читаются пачками, отметки о доставке записываются пачками.
+    Недоставленные при сбое сообщения отправляются при следующем запуске.
+    Перед отправкой сообщения захватываются в БД, поэтому несколько процессов
+    с общей БД не отправляют одно сообщение дважды; захват продлевается,
+    пока процесс работает.
+    """
+    def __init__(self, bot, db, batch_size=100, flush_interval=5, claim_seconds=300, sender=None):
+        """
+        :param bot: Открытый TelegramBot
+        :param db: IPDomainDatabaseAsync
+        :param batch_size: Количество сообщений, читаемых и отмечаемых за один запрос
+        :param flush_interval: Максимальный интервал между записями отметок, секунды
+        :param claim_seconds: Срок захвата сообщений; продлевается каждую треть срока
+        :param sender: Идентификатор процесса, по умолчанию хост:pid
+        """
+        self.bot = bot
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.claim_seconds = claim_seconds
+        self.sender = sender or f"{socket.gethostname()}:{os.getpid()}"
+        self.new_messages = asyncio.Event()
+        self.stopping = False
+        self._task = None
+        self._heartbeat_task = None
+
+    @property
+    def chat_ids(self):
+        return list(self.bot.chats)
+
+    def notify(self):
+        """
+        Сообщает, что в telegram_outbox добавлены сообщения.
+        """
+        self.new_messages.set()
+
+    async def flush(self):
+        """
+        Записывает в БД накопленные результаты отправки.
+        """
+        delivered, self.bot.delivered = self.bot.delivered, []
+        failed, self.bot.failed = self.bot.failed, []
+        await self.db.mark_outbox_delivered(delivered)
+        await self.db.mark_outbox_failed(failed)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.claim_seconds / 3)
+            await self.db.renew_outbox_claims(self.sender, self.claim_seconds)
+
+    async def _enqueue_pending(self):
+        """
+        Захватывает и передает боту все недоставленные сообщения, не захваченные
+        другими процессами.
+        :return: Количество переданных сообщений
+        """
+        count = 0
+        while rows := await self.db.claim_outbox_batch(self.sender, limit=self.batch_size,
+                                                       claim_seconds=self.claim_seconds):
+            for outbox_id, chat_id, message in rows:
+                await self.bot.add_outbox_message(outbox_id, chat_id, message)
+                count += 1
+                if len(self.bot.delivered) + len(self.bot.failed) >= self.batch_size:
+                    await self.flush()
+        return count
+
+    async def run(self):
+        while not self.stopping:
+            await self._enqueue_pending()
+            try:
+                await asyncio.wait_for(self.new_messages.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.new_messages.clear()
+            await self.flush()
+
+    async def __aenter__(self):
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.stopping = True
+        self.notify()
+        await self._task
+        # Досылаем оставшиеся сообщения и записываем последние отметки
+        await self._enqueue_pending()
+        await self.bot.wait_until_done()
+        await self.flush()
+        self._heartbeat_task.cancel()
+        await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+        logger.info("Очередь сообщений telegram_outbox обработана")
@@ -1,55 +1,181 @@
 import asyncio
 from aiogram import Bot, Dispatcher, html
-from aiogram.exceptions import TelegramRetryAfter, TelegramAPIError
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (TelegramAPIError, TelegramBadRequest, TelegramEntityTooLarge,
+                                TelegramForbiddenError, TelegramMigrateToChat, TelegramNotFound,
+                                TelegramRetryAfter, TelegramUnauthorizedError)
 from contextlib import asynccontextmanager
 
+from messages import logger
+from metrics import TG_MESSAGES, TG_QUEUE_DEPTH, TG_RETRIES, TG_SEND_SECONDS, span
+from request.rate_limiter import TokenBucket
+
+# Ошибки 4xx: повтор того же запроса даст ту же ошибку
+PERMANENT_ERRORS = (TelegramBadRequest, TelegramEntityTooLarge, TelegramForbiddenError, TelegramMigrateToChat,
+                    TelegramNotFound, TelegramUnauthorizedError)
+
+
+class ChatState:
+    """
+    Очередь сообщений одного чата и его бюджет сообщений в минуту.
+    """
+    def __init__(self, per_minute, queue_size=0):
+        # Элементы очереди: (сообщение, id в telegram_outbox или None)
+        self.queue: asyncio.Queue[tuple] = asyncio.Queue(queue_size)
+        self.bucket = TokenBucket(per_minute)
+
 
 class TelegramBot:
-    def __init__(self, token, channel_id, initial_delay=1):
-        self.bot = Bot(token=token)
+    def __init__(self, token, channel_id, initial_delay=1, queue_size=0,
+                 global_per_second=30, chat_per_minute=20, max_retries=5, api_url=None):
+        """
+        :param channel_id: Идентификатор канала, список или строка с идентификаторами через запятую
+        :param initial_delay: Начальная задержка повтора, удваивается с каждой попыткой
+        :param queue_size: Размер очереди сообщений каждого чата (0 — без ограничения)
+        :param global_per_second: Общий лимит сообщений в секунду
+        :param chat_per_minute: Лимит сообщений в минуту для одного чата
+        :param max_retries: Число попыток при ошибках сервера и сети, после которого сообщение
+                            попадает в dead_letters; ожидание retry_after попыткой не считается
+        :param api_url: Адрес Bot API (например, локальный сервер бенчмарка)
+        """
+        session = AiohttpSession(api=TelegramAPIServer.from_base(api_url)) if api_url else None
+        self.bot = Bot(token=token, session=session)
         self.dp = Dispatcher()
-        self.channel_id = channel_id
-        self.message_queue: asyncio.Queue[str] = asyncio.Queue()
+        if isinstance(channel_id, str):
+            channel_id = [chat.strip() for chat in channel_id.split(',') if chat.strip()]
+        elif not isinstance(channel_id, (list, tuple)):
+            channel_id = [channel_id]
+        # Каждый чат обслуживается своим отправителем: пауза retry_after
+        # и поканальный лимит задерживают только этот чат
+        self.chats = {str(chat_id): ChatState(chat_per_minute, queue_size) for chat_id in channel_id}
         self.delay = initial_delay
-
-    async def send_message(self, message):
-        try:
-            await self.bot.send_message(chat_id=self.channel_id, text=html.quote(message))
-            self.delay = 1  # Сброс задержки после успешной отправки
-        except TelegramRetryAfter as e:
-            # Слишком много запросов, необходимо подождать
-            self.delay = e.retry_after + 2
-            await self.message_queue.put(message)  # Повторно добавить сообщение в очередь
-        except TelegramAPIError:
-            # Другие API ошибки
-            await self.message_queue.put(message)  # Повторно добавить сообщение в очередь
-
-    async def process_queue(self):
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_per_second * 60)
+        self.dead_letters = []
+        # Результаты отправки сообщений из telegram_outbox: (id, message_id) и (id, ошибка)
+        self.delivered = []
+        self.failed = []
+        self._tasks = []
+
+    async def send_message(self, chat_id, message):
+        """
+        Отправляет сообщение в чат. После retry_after запрос повторяется без расхода
+        попытки, ошибки сервера и сети — с экспоненциальной задержкой, ошибки 4xx не повторяются.
+        :return: message_id отправленного сообщения; None, если оно попало в dead_letters
+        """
+        message_id, _ = await self._send(chat_id, message)
+        return message_id
+
+    async def _send(self, chat_id, message):
+        """
+        :return: Пара (message_id или None, текст ошибки этого сообщения или None)
+        """
+        with span('send'):
+            return await self._send_message(chat_id, message)
+
+    async def _send_message(self, chat_id, message):
+        chat = self.chats[chat_id]
+        attempt = 0
+        while True:
+            with span('rate_limit'):
+                await chat.bucket.acquire()
+                await self.global_bucket.acquire()
+            try:
+                with span('telegram_request'), TG_SEND_SECONDS.labels(chat_id).time():
+                    sent = await self.bot.send_message(chat_id=chat_id, text=html.quote(message))
+                TG_MESSAGES.labels(chat_id, 'sent').inc()
+                return sent.message_id, None
+            except TelegramRetryAfter as e:
+                # Слишком много запросов: сообщение верное, ждем и повторяем без расхода попытки
+                TG_RETRIES.labels(chat_id, 'retry_after').inc()
+                with span('backoff'):
+                    await asyncio.sleep(e.retry_after)
+                continue
+            except PERMANENT_ERRORS as e:
+                logger.error(f"Сообщение в чат {chat_id} не отправлено: {e}")
+                error = e
+                break
+            except TelegramAPIError as e:
+                # Другие API ошибки
+                error = e
+                attempt += 1
+                if attempt >= self.max_retries:
+                    logger.error(f"Сообщение в чат {chat_id} не отправлено после {self.max_retries} попыток: {e}")
+                    break
+                TG_RETRIES.labels(chat_id, 'api_error').inc()
+                with span('backoff'):
+                    await asyncio.sleep(self.delay * 2 ** (attempt - 1))
+        TG_MESSAGES.labels(chat_id, 'failed').inc()
+        self.dead_letters.append({'chat_id': chat_id, 'message': message, 'error': str(error)})
+        return None, str(error)
+
+    async def process_queue(self, chat_id):
+        queue = self.chats[chat_id].queue
         while True:
-            message = await self.message_queue.get()
-            await self.send_message(message)
-            await asyncio.sleep(self.delay)
-            self.message_queue.task_done()
+            message, outbox_id = await queue.get()
+            TG_QUEUE_DEPTH.labels(chat_id).set(queue.qsize())
+            try:
+                message_id, error = await self._send(chat_id, message)
+            except asyncio.CancelledError:
+                # Строка telegram_outbox остается без отметки: захват истечет,
+                # и сообщение будет отправлено снова
+                queue.task_done()
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка отправки сообщения в чат {chat_id}: {e}")
+                TG_MESSAGES.labels(chat_id, 'failed').inc()
+                self.dead_letters.append({'chat_id': chat_id, 'message': message, 'error': str(e)})
+                message_id, error = None, str(e)
+            if outbox_id is not None:
+                if message_id is None:
+                    self.failed.append((outbox_id, error))
+                else:
+                    self.delivered.append((outbox_id, message_id))
+            queue.task_done()
 
     async def add_to_queue(self, message: str):
-        await self.message_queue.put(message)
+        for chat_id, chat in self.chats.items():
+            await chat.queue.put((message, None))
+            TG_QUEUE_DEPTH.labels(chat_id).set(chat.queue.qsize())
+
+    async def add_outbox_message(self, outbox_id, chat_id, message):
+        """
+        Ставит в очередь сообщение из telegram_outbox.
+        Результат попадает в self.delivered или self.failed.
+        """
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            self.failed.append((outbox_id, f"Чат {chat_id} не настроен"))
+            return
+        await chat.queue.put((message, outbox_id))
+        TG_QUEUE_DEPTH.labels(chat_id).set(chat.queue.qsize())
 
     async def add_messages_to_queue(self, messages: list):
         for message in messages:
             await self.add_to_queue(message)
 
+    def start_workers(self):
+        self._tasks = [asyncio.create_task(self.process_queue(chat_id)) for chat_id in self.chats]
+
     async def start_polling(self):
-        asyncio.create_task(self.process_queue())
+        self.start_workers()
         await self.dp.start_polling(self.bot)
 
     async def wait_until_done(self):
-        await self.message_queue.join()
+        for chat in self.chats.values():
+            await chat.queue.join()
 
     async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.dead_letters:
+            logger.warning(f"Не доставлено сообщений: {len(self.dead_letters)}")
         await self.bot.session.close()
 
     async def __aenter__(self):
-        asyncio.create_task(self.process_queue())
+        self.start_workers()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
@@ -77,4 +203,4 @@ async def main():
         await bot.add_messages_to_queue(messages)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())